@@ -0,0 +1,309 @@
+from heapq import heappush, heappop
+from itertools import count
+from math import inf
+import numpy as np
+from MapCache import cached_artifact
+from terrain import OUT_OF_BOUNDS
+import search
+
+"""
+Hierarchical pathfinding in the style of HPA*. The grid is cut into square clusters, entrances
+are placed on the borders between neighbouring clusters and the travel times between the
+entrances of a cluster are computed once. A query searches this small abstract graph and then
+refines the route at pixel level inside the clusters the abstract path went through.
+"""
+
+# Entrances at least this long get a transition at each end instead of one in the middle
+LONG_ENTRANCE = 6
+START = -1
+FINAL = -2
+
+
+def local_dijkstra(grid, source, rect, targets, reverse=False):
+    """
+    Dijkstra restricted to a rectangle of the grid
+    :param grid: weighted grid
+    :param source: starting node
+    :param rect: (x0, y0, x1, y1), x1 and y1 excluded
+    :param targets: nodes whose travel time is needed
+    :param reverse: search travel times towards source instead of from it
+    :return: dictionary of reached target to travel time
+    """
+    x0, y0, x1, y1 = rect
+    remaining = set(targets)
+    tiebreak = count()
+    frontier = [(0.0, next(tiebreak), source)]
+    cost_so_far = {source: 0.0}
+    closed = set()
+    found = {}
+    if reverse and not grid.in_bounds(source):
+        # nothing can step onto an out of bounds node
+        return found
+    while frontier and remaining:
+        g_value, _, actual_node = heappop(frontier)
+        if actual_node in closed:
+            continue
+        closed.add(actual_node)
+        if actual_node in remaining:
+            remaining.discard(actual_node)
+            found[actual_node] = g_value
+        x, y = actual_node
+        for neighbor in grid.neighbors(x, y):
+            if neighbor in closed or not (x0 <= neighbor[0] < x1 and y0 <= neighbor[1] < y1):
+                continue
+            if reverse:
+                new_g = g_value + grid.cost(neighbor[0], neighbor[1], x, y)
+            else:
+                new_g = g_value + grid.cost(x, y, neighbor[0], neighbor[1])
+            if new_g < cost_so_far.get(neighbor, inf):
+                cost_so_far[neighbor] = new_g
+                heappush(frontier, (new_g, next(tiebreak), neighbor))
+    return found
+
+
+class ClusterGraph:
+    def __init__(self, grid, cluster_size=25, build=True):
+        """
+        Builds the abstract graph of a grid, only the abstract graph is kept so it can be
+        pickled or saved next to the season overlay
+        :param grid: weighted grid
+        :param cluster_size: side of a cluster in pixels
+        :param build: compute entrances and edges, False leaves an empty graph for load
+        """
+        self.cluster_size = cluster_size
+        self.width = grid.width
+        self.height = grid.height
+        self.fingerprint = grid.fingerprint()
+        self.nodes = []
+        self.node_index = {}
+        self.edges = []
+        self.cluster_nodes = {}
+        if build:
+            self.find_entrances(grid)
+            for cluster, members in self.cluster_nodes.items():
+                for i in members:
+                    costs = local_dijkstra(grid, self.nodes[i], self.cluster_rect(cluster),
+                                           [self.nodes[j] for j in members if j != i])
+                    for node, time in costs.items():
+                        self.add_edge(i, self.node_index[node], time)
+
+    def cluster_of(self, node):
+        """
+        Cluster holding a node
+        :param node: (x, y)
+        :return: (cluster x, cluster y)
+        """
+        return node[0] // self.cluster_size, node[1] // self.cluster_size
+
+    def cluster_rect(self, cluster):
+        """
+        Pixel rectangle of a cluster
+        :param cluster: (cluster x, cluster y)
+        :return: (x0, y0, x1, y1), x1 and y1 excluded
+        """
+        x0 = cluster[0] * self.cluster_size
+        y0 = cluster[1] * self.cluster_size
+        return x0, y0, min(x0 + self.cluster_size, self.width), min(y0 + self.cluster_size, self.height)
+
+    def add_node(self, node):
+        """
+        Adds an abstract node once
+        :param node: (x, y)
+        :return: index of the node
+        """
+        if node not in self.node_index:
+            self.node_index[node] = len(self.nodes)
+            self.nodes.append(node)
+            self.edges.append({})
+            self.cluster_nodes.setdefault(self.cluster_of(node), []).append(self.node_index[node])
+        return self.node_index[node]
+
+    def add_edge(self, i, j, time):
+        """
+        Adds a directed abstract edge, keeping the cheapest
+        :param i: index of the first node
+        :param j: index of the second node
+        :param time: travel time
+        :return: None
+        """
+        if time < self.edges[i].get(j, inf):
+            self.edges[i][j] = time
+
+    def find_entrances(self, grid):
+        """
+        Places transitions on every passable stretch of the cluster borders
+        :param grid: weighted grid
+        :return: None
+        """
+        passable = np.asarray(grid.terrain) != OUT_OF_BOUNDS
+        size = self.cluster_size
+        for x in range(size, self.width, size):
+            # vertical border between columns x - 1 and x
+            both = (passable[:, x - 1] & passable[:, x]).tolist()
+            for y0 in range(0, self.height, size):
+                for segment in self.segments(both, y0, min(y0 + size, self.height)):
+                    for y in segment:
+                        self.add_transition(grid, (x - 1, y), (x, y))
+        for y in range(size, self.height, size):
+            # horizontal border between rows y - 1 and y
+            both = (passable[y - 1, :] & passable[y, :]).tolist()
+            for x0 in range(0, self.width, size):
+                for segment in self.segments(both, x0, min(x0 + size, self.width)):
+                    for x in segment:
+                        self.add_transition(grid, (x, y - 1), (x, y))
+
+    def segments(self, both, begin, end):
+        """
+        Transition positions of the passable runs of a border
+        :param both: list telling if the pixels on both sides are passable
+        :param begin: first position of the border
+        :param end: position after the border
+        :return: list of transition positions per run
+        """
+        runs = []
+        run_start = None
+        for i in range(begin, end + 1):
+            if i < end and both[i]:
+                if run_start is None:
+                    run_start = i
+            elif run_start is not None:
+                if i - run_start >= LONG_ENTRANCE:
+                    runs.append([run_start, i - 1])
+                else:
+                    runs.append([(run_start + i - 1) // 2])
+                run_start = None
+        return runs
+
+    def add_transition(self, grid, a, b):
+        """
+        Links two pixels on either side of a border
+        :param grid: weighted grid
+        :param a: pixel in the first cluster
+        :param b: pixel in the second cluster
+        :return: None
+        """
+        i = self.add_node(a)
+        j = self.add_node(b)
+        self.add_edge(i, j, grid.cost(a[0], a[1], b[0], b[1]))
+        self.add_edge(j, i, grid.cost(b[0], b[1], a[0], a[1]))
+
+    def search(self, grid, start, final, stats=None):
+        """
+        Connects start and final to the entrances of their clusters, runs A* over the abstract
+        graph and refines the result with A* restricted to the clusters the abstract path uses.
+        The route is approximate, the best one may leave the corridor
+        :param grid: weighted grid the graph was built from
+        :param start: starting node
+        :param final: ending node
+        :param stats: optional dictionary that receives search counters
+        :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+        """
+        if start == final:
+            return [start], 0.0
+        start_cluster = self.cluster_of(start)
+        final_cluster = self.cluster_of(final)
+        targets = [self.nodes[j] for j in self.cluster_nodes.get(start_cluster, [])]
+        if start_cluster == final_cluster:
+            targets.append(final)
+        out_start = local_dijkstra(grid, start, self.cluster_rect(start_cluster), targets)
+        in_final = local_dijkstra(grid, final, self.cluster_rect(final_cluster),
+                                  [self.nodes[j] for j in self.cluster_nodes.get(final_cluster, [])], reverse=True)
+        start_edges = {FINAL if node == final else self.node_index[node]: time for node, time in out_start.items()}
+        final_edges = {self.node_index[node]: time for node, time in in_final.items()}
+
+        def position(i):
+            return start if i == START else final if i == FINAL else self.nodes[i]
+
+        def successors(i):
+            if i == START:
+                return start_edges.items()
+            if i in final_edges:
+                return list(self.edges[i].items()) + [(FINAL, final_edges[i])]
+            return self.edges[i].items()
+
+        xf, yf = final
+        tiebreak = count()
+        frontier = [(grid.heuristic(start[0], start[1], xf, yf), next(tiebreak), START)]
+        cost_so_far = {START: 0.0}
+        parents = {START: None}
+        closed = set()
+        while frontier:
+            f, _, actual_node = heappop(frontier)
+            if actual_node in closed:
+                continue
+            if actual_node == FINAL:
+                break
+            closed.add(actual_node)
+            for neighbor, time in successors(actual_node):
+                new_g = cost_so_far[actual_node] + time
+                if neighbor not in closed and new_g < cost_so_far.get(neighbor, inf):
+                    cost_so_far[neighbor] = new_g
+                    parents[neighbor] = actual_node
+                    x, y = position(neighbor)
+                    heappush(frontier, (new_g + grid.heuristic(x, y, xf, yf), next(tiebreak), neighbor))
+        if stats is not None:
+            stats["expanded_abstract"] = len(closed)
+            stats["approximate"] = True
+        if FINAL not in parents:
+            if stats is not None:
+                stats["expanded"] = len(closed)
+            return [], inf
+        # the corridor is the clusters of the abstract path and the clusters around them,
+        # which lets the refinement straighten out the detours imposed by the entrances
+        corridor = set()
+        for i in search.build_path(parents, FINAL):
+            cx, cy = self.cluster_of(position(i))
+            corridor.update((cx + dx, cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+        refine_stats = {"cells": stats["cells"]} if stats is not None and "cells" in stats else {}
+        path, time = search.a_star(grid, start, final, refine_stats,
+                                   allowed=lambda node: self.cluster_of(node) in corridor)
+        if stats is not None:
+            stats["expanded_refine"] = refine_stats["expanded"]
+            stats["expanded"] = len(closed) + refine_stats["expanded"]
+            stats["pushed"] = refine_stats["pushed"]
+            stats["stale"] = refine_stats["stale"]
+            stats["peak_frontier"] = refine_stats["peak_frontier"]
+        return path, time
+
+    def save(self, file_name):
+        """
+        Writes the abstract graph as an .npz file
+        :param file_name: output file
+        :return: None
+        """
+        sources = [i for i in range(len(self.nodes)) for j in self.edges[i]]
+        targets = [j for i in range(len(self.nodes)) for j in self.edges[i]]
+        times = [self.edges[i][j] for i in range(len(self.nodes)) for j in self.edges[i]]
+        np.savez(file_name, nodes=np.array(self.nodes, dtype=np.int32).reshape(-1, 2),
+                 sources=np.array(sources, dtype=np.int32), targets=np.array(targets, dtype=np.int32),
+                 times=np.array(times, dtype=np.float64),
+                 shape=np.array([self.cluster_size, self.width, self.height]),
+                 fingerprint=np.array(self.fingerprint))
+
+    @classmethod
+    def load(cls, grid, file_name):
+        """
+        Reads an abstract graph written by save
+        :param grid: weighted grid the graph belongs to
+        :param file_name: .npz file
+        :return: cluster graph, None if it was built from another grid
+        """
+        with np.load(file_name) as data:
+            if str(data["fingerprint"]) != grid.fingerprint():
+                return None
+            graph = cls(grid, int(data["shape"][0]), build=False)
+            for node in data["nodes"].tolist():
+                graph.add_node(tuple(node))
+            for i, j, time in zip(data["sources"].tolist(), data["targets"].tolist(), data["times"].tolist()):
+                graph.add_edge(i, j, time)
+        return graph
+
+    @classmethod
+    def cached(cls, grid, file_name):
+        """
+        Loads the abstract graph from file_name, building and saving it when missing or outdated
+        :param grid: weighted grid
+        :param file_name: .npz file
+        :return: cluster graph
+        """
+        return cached_artifact(file_name, lambda name: cls.load(grid, name), lambda: cls(grid))[0]
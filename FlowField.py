@@ -0,0 +1,132 @@
+import os
+import threading
+from collections import OrderedDict
+from math import inf
+import numpy as np
+from MapCache import cached_artifact
+from search import travel_times, STEPS, NO_STEP
+
+"""
+Flow fields for many starts converging on one goal. A single reverse Dijkstra from the goal
+gives every pixel its travel time and the step towards the goal, after which each start is
+routed by walking the steps without any further search.
+"""
+
+
+class FlowField:
+    def __init__(self, grid, goal, build=True):
+        """
+        Travel time to one goal from every pixel and the step to take next, from a single
+        reverse Dijkstra. Any start is then routed by following the steps
+        :param grid: weighted grid
+        :param goal: ending node shared by every start
+        :param build: run the search, False leaves the field empty for load
+        """
+        self.goal = goal
+        self.width = grid.width
+        self.height = grid.height
+        self.fingerprint = grid.fingerprint()
+        self.times = None
+        self.steps = None
+        if build:
+            times, steps = travel_times(grid, goal, reverse=True, steps=True)
+            self.times = times.reshape(grid.height, grid.width)
+            self.steps = steps.reshape(grid.height, grid.width)
+
+    def time(self, start):
+        """
+        Travel time from start to the goal, rounded to float32
+        :param start: starting node
+        :return: travel time, inf if unreachable
+        """
+        return float(self.times[start[1], start[0]])
+
+    def path(self, start):
+        """
+        Follows the steps from start down to the goal
+        :param start: starting node
+        :return: list of nodes from start to the goal, [] if unreachable
+        """
+        if self.times[start[1], start[0]] == inf:
+            return []
+        path = [start]
+        x, y = start
+        steps = self.steps
+        while (x, y) != self.goal:
+            k = steps.item(y, x)
+            if k == NO_STEP or len(path) > self.width * self.height:
+                return []
+            x += STEPS[k][0]
+            y += STEPS[k][1]
+            path.append((x, y))
+        return path
+
+    def save(self, file_name):
+        """
+        Writes the field as an .npz file
+        :param file_name: output file
+        :return: None
+        """
+        np.savez(file_name, times=self.times, steps=self.steps, goal=np.array(self.goal),
+                 fingerprint=np.array(self.fingerprint))
+
+    @classmethod
+    def load(cls, grid, file_name):
+        """
+        Reads a field written by save
+        :param grid: weighted grid the field belongs to
+        :param file_name: .npz file
+        :return: flow field, None if it was computed for another grid
+        """
+        with np.load(file_name) as data:
+            if str(data["fingerprint"]) != grid.fingerprint():
+                return None
+            field = cls(grid, tuple(data["goal"].tolist()), build=False)
+            field.times = data["times"]
+            field.steps = data["steps"]
+        return field
+
+
+class FlowFieldCache:
+    def __init__(self, max_fields=16, cache_dir=None):
+        """
+        Flow fields per (grid fingerprint, goal) in an in memory LRU, optionally saved to a directory
+        :param max_fields: number of fields kept in memory
+        :param cache_dir: optional directory of saved fields
+        """
+        self.max_fields = max_fields
+        self.cache_dir = cache_dir
+        self.fields = OrderedDict()
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, grid, goal, stats=None):
+        """
+        Flow field of a goal, computed on a miss
+        :param grid: weighted grid
+        :param goal: ending node
+        :param stats: optional dictionary that receives the pixels expanded to build the field
+        :return: flow field
+        """
+        key = (grid.fingerprint(), goal)
+        with self.lock:
+            if key in self.fields:
+                self.fields.move_to_end(key)
+                if stats is not None:
+                    stats["expanded"] = 0
+                return self.fields[key]
+        if self.cache_dir is not None:
+            file_name = os.path.join(self.cache_dir, "%s_%d_%d.npz" % (key[0], goal[0], goal[1]))
+            field, built = cached_artifact(file_name, lambda name: FlowField.load(grid, name),
+                                           lambda: FlowField(grid, goal))
+        else:
+            field, built = FlowField(grid, goal), True
+        if stats is not None:
+            stats["expanded"] = int(np.isfinite(field.times).sum()) if built else 0
+        with self.lock:
+            self.fields[key] = field
+            self.fields.move_to_end(key)
+            while len(self.fields) > self.max_fields:
+                self.fields.popitem(last=False)
+        return field
@@ -0,0 +1,123 @@
+from math import inf
+import numpy as np
+from MapCache import cached_artifact
+from search import travel_times
+from terrain import OUT_OF_BOUNDS
+
+"""
+Landmark (ALT) lower bounds. For a landmark L the triangle inequality gives
+d(v, t) >= d(v, L) - d(t, L) and d(v, t) >= d(L, t) - d(L, v), so travel time tables to and
+from a few landmarks bound every leg far tighter than a straight line at the top speed.
+"""
+
+# float32 tables round every travel time, the bounds are lowered by this much to stay admissible
+ROUNDING_SLACK = 1e-3
+
+
+class Landmarks:
+    def __init__(self, grid, count=8, build=True):
+        """
+        Selects landmarks by farthest travel time and precomputes the tables to and from them
+        :param grid: weighted grid
+        :param count: number of landmarks
+        :param build: select and compute, False leaves empty tables for load
+        """
+        self.width = grid.width
+        self.fingerprint = grid.fingerprint()
+        self.nodes = []
+        # row v holds the 2 * count travel times of pixel v, d(L_k, v) at 2 * k and d(v, L_k) at 2 * k + 1
+        self.table = np.zeros((grid.width * grid.height, 0), dtype=np.float32)
+        if build:
+            self.select(grid, count)
+
+    def select(self, grid, count):
+        """
+        Farthest landmark selection, each new landmark is the reachable pixel farthest
+        from the landmarks chosen so far
+        :param grid: weighted grid
+        :param count: number of landmarks
+        :return: None
+        """
+        passable = (np.asarray(grid.terrain) != OUT_OF_BOUNDS).ravel()
+        if not passable.any():
+            return
+        # begin from the passable pixel closest to the middle of the map
+        ys, xs = np.divmod(np.flatnonzero(passable), grid.width)
+        middle = np.argmin((xs - grid.width / 2) ** 2 + (ys - grid.height / 2) ** 2)
+        distance = travel_times(grid, (int(xs[middle]), int(ys[middle])))
+        rows = []
+        for k in range(count):
+            candidates = np.where(np.isfinite(distance) & passable, distance, -1)
+            i = int(np.argmax(candidates))
+            if candidates[i] <= 0 and k > 0:
+                break
+            node = (i % grid.width, i // grid.width)
+            self.nodes.append(node)
+            rows.append(travel_times(grid, node))
+            rows.append(travel_times(grid, node, reverse=True))
+            distance = rows[-2] if k == 0 else np.minimum(distance, rows[-2])
+        if rows:
+            self.table = np.ascontiguousarray(np.array(rows, dtype=np.float32).T)
+
+    def lower_bound(self, grid, final):
+        """
+        Lower bound of the travel time to final, only the table row of a pixel the search asks
+        about is read
+        :param grid: weighted grid
+        :param final: ending node
+        :return: function of the flat index y * width + x of a pixel
+        """
+        table = self.table
+        target = table[final[1] * self.width + final[0]].tolist()
+        pairs = [(k, target[k], target[k + 1]) for k in range(0, len(target), 2)]
+
+        def bound(j):
+            row = table[j].tolist()
+            best = ROUNDING_SLACK
+            for k, from_final, to_final in pairs:
+                # d(v, t) >= d(v, L) - d(t, L) and d(v, t) >= d(L, t) - d(L, v), unreachable
+                # landmarks give infinite or undefined terms that bound nothing
+                ahead = row[k + 1] - to_final
+                behind = from_final - row[k]
+                if best < ahead < inf:
+                    best = ahead
+                if best < behind < inf:
+                    best = behind
+            return best - ROUNDING_SLACK
+
+        return bound
+
+    def save(self, file_name):
+        """
+        Writes the landmark tables as an .npz file
+        :param file_name: output file
+        :return: None
+        """
+        np.savez(file_name, nodes=np.array(self.nodes, dtype=np.int32).reshape(-1, 2), table=self.table.T,
+                 fingerprint=np.array(self.fingerprint))
+
+    @classmethod
+    def load(cls, grid, file_name):
+        """
+        Reads landmark tables written by save
+        :param grid: weighted grid the tables belong to
+        :param file_name: .npz file
+        :return: landmarks, None if they were computed for another grid
+        """
+        with np.load(file_name) as data:
+            if str(data["fingerprint"]) != grid.fingerprint():
+                return None
+            landmarks = cls(grid, build=False)
+            landmarks.nodes = [tuple(node) for node in data["nodes"].tolist()]
+            landmarks.table = np.ascontiguousarray(data["table"].T)
+        return landmarks
+
+    @classmethod
+    def cached(cls, grid, file_name):
+        """
+        Loads the landmarks from file_name, computing and saving them when missing or outdated
+        :param grid: weighted grid
+        :param file_name: .npz file
+        :return: landmarks
+        """
+        return cached_artifact(file_name, lambda name: cls.load(grid, name), lambda: cls(grid))[0]
@@ -0,0 +1,141 @@
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+import search
+
+
+class LegCache:
+    def __init__(self, max_entries=4096, store_file=None):
+        """
+        Memoized optimal legs keyed by start, end, season and the fingerprint of the grid, held
+        in an in memory LRU and optionally persisted to an sqlite file shared between runs
+        :param max_entries: number of legs kept in memory
+        :param store_file: optional sqlite file
+        """
+        self.max_entries = max_entries
+        self.legs = OrderedDict()
+        self.lock = threading.Lock()
+        self.store = None
+        if store_file is not None:
+            self.store = sqlite3.connect(store_file, check_same_thread=False)
+            with self.store:
+                self.store.execute("CREATE TABLE IF NOT EXISTS legs (key TEXT PRIMARY KEY, path TEXT, time REAL)")
+
+    def key(self, grid, season, start, final):
+        """
+        Key of a leg
+        :param grid: weighted grid the leg is solved on
+        :param season: season
+        :param start: starting node
+        :param final: ending node
+        :return: key string
+        """
+        return "exact:%s:%s:%d,%d:%d,%d" % (season, grid.fingerprint(), start[0], start[1], final[0], final[1])
+
+    def get(self, grid, season, start, final):
+        """
+        Looks up a leg in memory, then in the persistent store
+        :param grid: weighted grid
+        :param season: season
+        :param start: starting node
+        :param final: ending node
+        :return: (path, travel time), None on a miss
+        """
+        key = self.key(grid, season, start, final)
+        with self.lock:
+            if key in self.legs:
+                self.legs.move_to_end(key)
+                return self.legs[key]
+            if self.store is None:
+                return None
+            row = self.store.execute("SELECT path, time FROM legs WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            leg = ([tuple(point) for point in json.loads(row[0])], row[1])
+            self.remember(key, leg)
+            return leg
+
+    def put(self, grid, season, start, final, path, time):
+        """
+        Stores a solved leg, which must be optimal
+        :param grid: weighted grid
+        :param season: season
+        :param start: starting node
+        :param final: ending node
+        :param path: list of nodes from start to final
+        :param time: travel time of the path
+        :return: None
+        """
+        key = self.key(grid, season, start, final)
+        with self.lock:
+            self.remember(key, (path, time))
+            if self.store is not None:
+                with self.store:
+                    self.store.execute("INSERT OR REPLACE INTO legs VALUES (?, ?, ?)",
+                                       (key, json.dumps(path), time))
+
+    def remember(self, key, leg):
+        """
+        Adds a leg to the in memory LRU, the caller holds the lock
+        :param key: key string
+        :param leg: (path, travel time)
+        :return: None
+        """
+        self.legs[key] = leg
+        self.legs.move_to_end(key)
+        while len(self.legs) > self.max_entries:
+            self.legs.popitem(last=False)
+
+    def solve(self, grid, season, start, final, stats=None, method="astar", options=None):
+        """
+        Returns a memoized leg or solves and stores it, only optimal legs are stored
+        :param grid: weighted grid
+        :param season: season
+        :param start: starting node
+        :param final: ending node
+        :param stats: optional dictionary that receives search counters
+        :param method: name of the engine in search.ENGINES
+        :param options: optional keyword arguments of the engine, such as the budget of the anytime engine
+        :return: (path, travel time)
+        """
+        leg = self.get(grid, season, start, final)
+        if leg is not None:
+            if stats is not None:
+                # memoized legs are optimal and cost no search
+                stats["cached"] = True
+                stats["expanded"] = 0
+                stats["bound"] = 1.0
+            return leg
+        counters = {} if stats is None else stats
+        path, time = search.ENGINES[method](grid, start, final, counters, **(options or {}))
+        # approximate legs would be served to callers wanting the best path
+        if path and search.is_exact(method, counters):
+            self.put(grid, season, start, final, path, time)
+        return path, time
+
+    def populate(self, grid, season, start, targets, stats=None):
+        """
+        Fills the legs from start to every target with a single one to many Dijkstra
+        :param grid: weighted grid
+        :param season: season
+        :param start: starting node
+        :param targets: nodes to reach
+        :param stats: optional dictionary that receives search counters
+        :return: dictionary of target to (path, travel time)
+        """
+        missing = [target for target in targets if self.get(grid, season, start, target) is None]
+        if missing:
+            for target, (path, time) in search.dijkstra(grid, start, missing, stats).items():
+                if path:
+                    self.put(grid, season, start, target, path, time)
+        return {target: self.get(grid, season, start, target) for target in targets}
+
+    def close(self):
+        """
+        Closes the persistent store
+        :return: None
+        """
+        if self.store is not None:
+            self.store.close()
+            self.store = None
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy as np
+
+# Bump when the layout of a cache entry changes
+CACHE_VERSION = "1"
+CACHE_ARRAYS = ("terrain", "elevation", "season_terrain", "speed")
+
+
+def cached_artifact(file_name, load, build):
+    """
+    Loads a structure derived from a map, such as a cluster graph, building and saving it when
+    the file is missing, unreadable or outdated. Readers never see a partly written file
+    :param file_name: .npz file
+    :param load: function of the file name returning the structure, None when it is outdated
+    :param build: function returning a new structure with a save(file_name) method
+    :return: (structure, True when it was built)
+    """
+    if os.path.exists(file_name):
+        try:
+            artifact = load(file_name)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            artifact = None
+        if artifact is not None:
+            return artifact, False
+    artifact = build()
+    temp_file = file_name + ".%d.tmp.npz" % os.getpid()
+    artifact.save(temp_file)
+    os.replace(temp_file, file_name)
+    return artifact, True
+
+
+class MapCache:
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024):
+        """
+        On disk cache of preprocessed maps, one directory of .npy files per entry.
+        Entries are keyed by content hashes of the input files and the season,
+        the least recently used entries are evicted once max_bytes is exceeded
+        :param cache_dir: directory holding the entries
+        :param max_bytes: size budget of the whole cache
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.file_hashes = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def file_hash(self, file_name):
+        """
+        Content hash of an input file, remembered while the file is unchanged
+        :param file_name: file to hash
+        :return: hex digest
+        """
+        stat = os.stat(file_name)
+        stamp = (os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+        if stamp not in self.file_hashes:
+            digest = hashlib.sha256()
+            with open(file_name, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            self.file_hashes[stamp] = digest.hexdigest()
+        return self.file_hashes[stamp]
+
+    def key(self, image_file, elevation_file, season):
+        """
+        Cache key of a preprocessed map
+        :param image_file: terrain image file
+        :param elevation_file: elevation file
+        :param season: season
+        :return: key string
+        """
+        digest = hashlib.sha256()
+        for part in (CACHE_VERSION, self.file_hash(image_file), self.file_hash(elevation_file), season):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()[:32]
+
+    def load(self, image_file, elevation_file, season):
+        """
+        Memory maps a cached map
+        :param image_file: terrain image file
+        :param elevation_file: elevation file
+        :param season: season
+        :return: dictionary of read only arrays, None on a miss
+        """
+        entry = os.path.join(self.cache_dir, self.key(image_file, elevation_file, season))
+        if not os.path.isdir(entry):
+            return None
+        try:
+            arrays = {name: np.load(os.path.join(entry, name + ".npy"), mmap_mode="r") for name in CACHE_ARRAYS}
+        except (OSError, ValueError):
+            return None
+        # mark as recently used
+        os.utime(entry)
+        return arrays
+
+    def entry_file(self, image_file, elevation_file, season, name):
+        """
+        Path of an extra file kept inside a cache entry, such as a cluster graph, so that it is
+        evicted together with the map it was derived from
+        :param image_file: terrain image file
+        :param elevation_file: elevation file
+        :param season: season
+        :param name: file name inside the entry
+        :return: file path, None when the entry is not stored
+        """
+        entry = os.path.join(self.cache_dir, self.key(image_file, elevation_file, season))
+        if not os.path.isdir(entry):
+            return None
+        return os.path.join(entry, name)
+
+    def store(self, image_file, elevation_file, season, arrays):
+        """
+        Writes a preprocessed map, the entry only becomes visible once it is complete
+        :param image_file: terrain image file
+        :param elevation_file: elevation file
+        :param season: season
+        :param arrays: dictionary holding every array of CACHE_ARRAYS
+        :return: None
+        """
+        entry = os.path.join(self.cache_dir, self.key(image_file, elevation_file, season))
+        temp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            for name in CACHE_ARRAYS:
+                np.save(os.path.join(temp_dir, name + ".npy"), np.ascontiguousarray(arrays[name]))
+            os.rename(temp_dir, entry)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in max_bytes
+        :return: None
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry))
+            entries.append((os.stat(entry).st_mtime, size, entry))
+            total += size
+        entries.sort()
+        for used, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,169 @@
+import json
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+import numpy as np
+from render import heatmap_image
+
+"""
+Opt in instrumentation. A Profiler times the stages of a run and records the search counters of
+every leg as JSON lines, with the peak traced memory when memory tracing is on and a count of
+how often every cell was expanded when a heatmap is wanted. Nothing is measured without one.
+"""
+
+
+def stage(profiler, name, **fields):
+    """
+    Times a stage when a profiler is given
+    :param profiler: Profiler or None
+    :param name: stage name
+    :param fields: extra fields of the record
+    :return: context manager
+    """
+    return profiler.stage(name, **fields) if profiler is not None else nullcontext()
+
+
+class Profiler:
+    def __init__(self, records_file=None, memory=False, heatmap=False):
+        """
+        Collects stage and leg records
+        :param records_file: optional JSON lines file receiving every record as it is made
+        :param memory: trace allocations with tracemalloc to report peak memory, slows the run down
+        :param heatmap: count the expanded cells of every leg
+        """
+        self.records = []
+        self.records_file = open(records_file, "w") if records_file is not None else None
+        self.memory = memory
+        self.heatmap = heatmap
+        self.heat = None
+        self.lock = threading.Lock()
+        # peaks of the scopes being measured, a nested scope folds the peak so far into them
+        self.scopes = []
+        self.tracing = memory and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+
+    def emit(self, record):
+        """
+        Keeps a record and appends it to the records file
+        :param record: JSON serializable dictionary
+        :return: None
+        """
+        with self.lock:
+            self.records.append(record)
+            if self.records_file is not None:
+                self.records_file.write(json.dumps(record) + "\n")
+                self.records_file.flush()
+
+    @contextmanager
+    def measure(self, record):
+        """
+        Adds the wall time, and the peak traced memory when tracing, of a block to a record
+        :param record: dictionary receiving seconds and peak_bytes
+        :return: None
+        """
+        scope = {"peak": 0}
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            for outer in self.scopes:
+                outer["peak"] = max(outer["peak"], peak)
+            tracemalloc.reset_peak()
+            self.scopes.append(scope)
+        began = perf_counter()
+        try:
+            yield
+        finally:
+            record["seconds"] = perf_counter() - began
+            if self.memory:
+                self.scopes.remove(scope)
+                record["peak_bytes"] = max(scope["peak"], tracemalloc.get_traced_memory()[1])
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Times a stage of the run, such as image load or rendering
+        :param name: stage name
+        :param fields: extra fields of the record
+        :return: None
+        """
+        record = {"type": "stage", "stage": name}
+        record.update(fields)
+        try:
+            with self.measure(record):
+                yield
+        finally:
+            self.emit(record)
+
+    @contextmanager
+    def leg(self, grid, start, final, **fields):
+        """
+        Measures one leg solved inside the block
+        :param grid: weighted grid the leg is solved on
+        :param start: starting node
+        :param final: ending node
+        :param fields: extra fields of the record, such as the season
+        :return: stats dictionary to hand to the search
+        """
+        stats = self.leg_stats()
+        record = {}
+        try:
+            with self.measure(record):
+                yield stats
+        finally:
+            stats.update(record)
+            self.record_leg(grid, start, final, stats, **fields)
+
+    def leg_stats(self):
+        """
+        Empty search counters, asking the engines for the expanded cells when a heatmap is wanted
+        :return: stats dictionary
+        """
+        return {"cells": []} if self.heatmap else {}
+
+    def record_leg(self, grid, start, final, stats, **fields):
+        """
+        Records the counters of a leg solved elsewhere, e.g. in a worker process
+        :param grid: weighted grid the leg was solved on
+        :param start: starting node
+        :param final: ending node
+        :param stats: search counters of the leg
+        :param fields: extra fields of the record
+        :return: None
+        """
+        record = {"type": "leg", "start": list(start), "end": list(final)}
+        record.update(fields)
+        record.update((name, value) for name, value in stats.items() if name != "cells")
+        cells = stats.get("cells")
+        if self.heatmap and cells:
+            with self.lock:
+                if self.heat is None:
+                    self.heat = np.zeros((grid.height, grid.width), dtype=np.uint32)
+                xs, ys = np.array(cells, dtype=np.int64).reshape(-1, 2).T
+                np.add.at(self.heat, (ys, xs), 1)
+        self.emit(record)
+
+    def save_heatmap(self, file_name, terrain=None):
+        """
+        Writes how often every cell was expanded as an image
+        :param file_name: output image file
+        :param terrain: optional terrain class array drawn faintly underneath
+        :return: None
+        """
+        heat = self.heat
+        if heat is None:
+            shape = terrain.shape if terrain is not None else (1, 1)
+            heat = np.zeros(shape, dtype=np.uint32)
+        heatmap_image(heat, terrain).save(file_name)
+
+    def close(self):
+        """
+        Closes the records file and stops the memory tracing it started
+        :return: None
+        """
+        if self.records_file is not None:
+            self.records_file.close()
+            self.records_file = None
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
@@ -0,0 +1,208 @@
+from heapq import heappush, heappop
+from itertools import count
+from math import inf
+import numpy as np
+
+"""
+Incremental replanning of one leg with Lifelong Planning A* (LPA*). The search keeps g, the
+travel time found so far, and rhs, the best travel time offered by the predecessors, for every
+node it touched. When cells of the map change only the nodes around them are made inconsistent
+again, so a closure or a new speed repairs the affected part of the search instead of starting over.
+"""
+
+# Repairing costs more than planning again once this share of the searched nodes has changed
+RESTART_FRACTION = 0.05
+
+
+def changed_cells(old_grid, new_grid):
+    """
+    Cells whose terrain, speed or elevation differ between two grids of the same map
+    :param old_grid: weighted grid before the change
+    :param new_grid: weighted grid after the change
+    :return: list of (x, y)
+    """
+    changed = np.zeros((new_grid.height, new_grid.width), dtype=bool)
+    for name in ("terrain", "speed", "elevation"):
+        old = getattr(old_grid, name)
+        new = getattr(new_grid, name)
+        if old is not new:
+            changed |= np.asarray(old) != np.asarray(new)
+    ys, xs = np.nonzero(changed)
+    return list(zip(xs.tolist(), ys.tolist()))
+
+
+class Replanner:
+    def __init__(self, grid, start, final):
+        """
+        Search state of one leg, kept between plans
+        :param grid: weighted grid
+        :param start: starting node
+        :param final: ending node
+        """
+        self.start = start
+        self.final = final
+        self.reset(grid)
+
+    def reset(self, grid):
+        """
+        Forgets the search state, the next plan starts from scratch
+        :param grid: weighted grid
+        :return: None
+        """
+        self.grid = grid
+        self.max_speed = grid.max_speed
+        self.g = {}
+        self.rhs = {self.start: 0.0}
+        # lazy deletion, a heap entry is live while it matches the key in open
+        self.open = {}
+        self.frontier = []
+        self.tiebreak = count()
+        self.push(self.start)
+
+    def key(self, node):
+        """
+        Priority of a node, smaller is expanded first
+        :param node: (x, y)
+        :return: (f value, g value)
+        """
+        best = min(self.g.get(node, inf), self.rhs.get(node, inf))
+        return best + self.grid.heuristic(node[0], node[1], self.final[0], self.final[1]), best
+
+    def push(self, node):
+        """
+        Queues an inconsistent node with its current key
+        :param node: (x, y)
+        :return: None
+        """
+        key = self.key(node)
+        self.open[node] = key
+        heappush(self.frontier, (key, next(self.tiebreak), node))
+
+    def predecessors(self, x, y):
+        """
+        Nodes with a step onto (x, y), nothing steps onto an out of bounds node
+        and only the start can be left from one
+        :param x: x coordinate
+        :param y: y coordinate
+        :return: list of nodes
+        """
+        grid = self.grid
+        if not grid.in_bounds((x, y)):
+            return []
+        return [node for node in ((x, y + 1), (x + 1, y), (x - 1, y), (x, y - 1))
+                if grid.in_bounds(node) or node == self.start]
+
+    def update_vertex(self, node):
+        """
+        Recomputes rhs of a node from its predecessors and queues it when inconsistent
+        :param node: (x, y)
+        :return: None
+        """
+        if node != self.start:
+            g = self.g
+            cost = self.grid.cost
+            x, y = node
+            self.rhs[node] = min([g.get(p, inf) + cost(p[0], p[1], x, y) for p in self.predecessors(x, y)],
+                                 default=inf)
+        if self.g.get(node, inf) != self.rhs.get(node, inf):
+            if self.open.get(node) != self.key(node):
+                self.push(node)
+        else:
+            self.open.pop(node, None)
+
+    def compute(self, stats=None):
+        """
+        Expands inconsistent nodes until the travel time of the final node is settled
+        :param stats: optional dictionary that receives search counters
+        :return: None
+        """
+        expanded = 0
+        stale = 0
+        g = self.g
+        rhs = self.rhs
+        final = self.final
+        grid = self.grid
+        while self.frontier:
+            key, _, node = self.frontier[0]
+            if self.open.get(node) != key:
+                heappop(self.frontier)
+                stale += 1
+                continue
+            if key >= self.key(final) and rhs.get(final, inf) == g.get(final, inf):
+                break
+            heappop(self.frontier)
+            del self.open[node]
+            expanded += 1
+            if g.get(node, inf) > rhs.get(node, inf):
+                g[node] = rhs[node]
+            else:
+                g[node] = inf
+                self.update_vertex(node)
+            for neighbor in grid.neighbors(node[0], node[1]):
+                self.update_vertex(neighbor)
+        if stats is not None:
+            stats["expanded"] = stats.get("expanded", 0) + expanded
+            stats["stale"] = stats.get("stale", 0) + stale
+            stats["open"] = len(self.open)
+
+    def path(self):
+        """
+        Walks back from the final node through the predecessors that give its travel time
+        :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+        """
+        time = self.g.get(self.final, inf)
+        if time == inf:
+            return [], inf
+        g = self.g
+        cost = self.grid.cost
+        path = [self.final]
+        x, y = self.final
+        while (x, y) != self.start:
+            if len(path) > len(g):
+                return [], inf
+            x, y = min(self.predecessors(x, y), key=lambda p: g.get(p, inf) + cost(p[0], p[1], x, y))
+            path.append((x, y))
+        path.reverse()
+        return path, time
+
+    def plan(self, stats=None):
+        """
+        Shortest travel time path of the leg on the current grid
+        :param stats: optional dictionary that receives search counters
+        :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+        """
+        self.compute(stats)
+        return self.path()
+
+    def update(self, grid, cells=None, stats=None):
+        """
+        Moves the search to a changed grid of the same map and repairs the path
+        :param grid: weighted grid after the change, such as a closure or new terrain speeds
+        :param cells: changed (x, y) cells, found by comparing the grids when not given
+        :param stats: optional dictionary that receives search counters
+        :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+        """
+        if cells is None:
+            cells = changed_cells(self.grid, grid)
+        if stats is not None:
+            stats["changed"] = len(cells)
+        if sum(1 for cell in cells if cell in self.rhs) > RESTART_FRACTION * len(self.rhs):
+            # widespread changes, such as the speed of a common terrain type
+            self.reset(grid)
+            return self.plan(stats)
+        rekey = grid.max_speed != self.max_speed or grid.elevation is not self.grid.elevation
+        self.grid = grid
+        if rekey:
+            # the heuristic changed with the top speed or the elevation, every queued key is recomputed
+            self.max_speed = grid.max_speed
+            self.frontier = []
+            for node in list(self.open):
+                self.push(node)
+        # a cell changes the steps leaving it and the steps onto it
+        affected = set()
+        for x, y in cells:
+            affected.update(((x, y), (x, y + 1), (x + 1, y), (x - 1, y), (x, y - 1)))
+        for node in affected:
+            if 0 <= node[0] < grid.width and 0 <= node[1] < grid.height:
+                self.update_vertex(node)
+        return self.plan(stats)
@@ -0,0 +1,203 @@
+from contextlib import contextmanager
+from heapq import heappush, heappop
+from math import inf, sqrt
+import threading
+import numpy as np
+from terrain import OUT_OF_BOUNDS, PIXEL_WIDTH, PIXEL_HEIGHT
+
+"""
+A* on flat arrays indexed by y * width + x. The read only rasters of a grid are read through
+flat memory views, which cost no copy and also work over shared memory, the scratch arrays of a
+search live in a workspace that is reused by later searches. A workspace is reset in O(1) by bumping its generation, a slot only
+counts as written when its stamp equals the current generation.
+"""
+
+
+def flat_view(array):
+    """
+    Flat view of a raster, indexing it gives python numbers without copying the raster
+    :param array: 2D array, indexed [y, x]
+    :return: memoryview indexed by y * width + x
+    """
+    return memoryview(np.ascontiguousarray(array).reshape(-1))
+
+
+class FlatGrid:
+    def __init__(self, grid):
+        """
+        Flat views of the per pixel values a search reads
+        :param grid: weighted grid with dense terrain, elevation and speed arrays
+        """
+        self.width = grid.width
+        self.height = grid.height
+        self.max_speed = grid.max_speed
+        self.fingerprint = grid.fingerprint()
+        self.terrain = flat_view(grid.terrain)
+        # python floats of the float32 values, the step costs are the same as grid.cost
+        self.elevation = flat_view(grid.elevation)
+        self.speed = flat_view(grid.speed)
+
+
+def flat_grid(grid):
+    """
+    Flat arrays of a grid, built on first use and rebuilt when the grid changed
+    :param grid: weighted grid
+    :return: FlatGrid
+    """
+    flat = grid.flat
+    if flat is None or flat.fingerprint != grid.fingerprint() or flat.max_speed != grid.max_speed:
+        flat = grid.flat = FlatGrid(grid)
+    return flat
+
+
+class SearchWorkspace:
+    def __init__(self):
+        """
+        Scratch arrays of a search, grown to the largest grid searched so far
+        """
+        self.size = 0
+        self.generation = 0
+        self.g = []
+        self.parent = []
+        # generation in which g and parent of a slot were written, and in which it was closed
+        self.seen = []
+        self.closed = []
+        self.frontier = []
+
+    def reset(self, size):
+        """
+        Invalidates every slot by starting a new generation
+        :param size: number of pixels of the grid about to be searched
+        :return: generation of the search
+        """
+        if size > self.size:
+            grow = size - self.size
+            self.g.extend([inf] * grow)
+            self.parent.extend([-1] * grow)
+            self.seen.extend([0] * grow)
+            self.closed.extend([0] * grow)
+            self.size = size
+        self.generation += 1
+        self.frontier.clear()
+        return self.generation
+
+    def a_star(self, grid, start, final, stats=None, bound=None, reopen=False):
+        """
+        A* with a binary heap and lazy deletion, expands the same nodes in the same order as
+        search.a_star and returns the same path
+        :param grid: weighted grid
+        :param start: starting node
+        :param final: ending node
+        :param stats: optional dictionary that receives search counters
+        :param bound: optional function giving a lower bound of the travel time to final from
+                      the flat index of a pixel, defaults to the straight line bound of the grid
+        :param reopen: let closed nodes be improved again, see search.a_star
+        :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+        """
+        flat = flat_grid(grid)
+        width = flat.width
+        size = width * flat.height
+        generation = self.reset(size)
+        g = self.g
+        parent = self.parent
+        seen = self.seen
+        closed = self.closed
+        frontier = self.frontier
+        terrain = flat.terrain
+        elevation = flat.elevation
+        speed = flat.speed
+        max_speed = flat.max_speed
+        xf, yf = final
+        t = yf * width + xf
+        zf = elevation[t]
+        # (flat offset, x offset, squared step length) in the order of Grid.neighbors
+        steps = ((width, 0, PIXEL_HEIGHT * PIXEL_HEIGHT), (1, 1, PIXEL_WIDTH * PIXEL_WIDTH),
+                 (-1, -1, PIXEL_WIDTH * PIXEL_WIDTH), (-width, 0, PIXEL_HEIGHT * PIXEL_HEIGHT))
+
+        def heuristic(j, x, y):
+            if bound is not None:
+                return bound(j)
+            dx = (xf - x) * PIXEL_WIDTH
+            dy = (yf - y) * PIXEL_HEIGHT
+            dz = zf - elevation[j]
+            return sqrt(dx * dx + dy * dy + dz * dz) / max_speed
+
+        s = start[1] * width + start[0]
+        g[s] = 0.0
+        parent[s] = -1
+        seen[s] = generation
+        tiebreak = 1
+        heappush(frontier, (heuristic(s, start[0], start[1]), 0, s))
+        expanded = 0
+        pushed = 1
+        stale = 0
+        peak_frontier = 1
+        found = False
+        while frontier:
+            f, _, i = heappop(frontier)
+            if closed[i] == generation:
+                stale += 1
+                continue
+            if i == t:
+                found = True
+                break
+            closed[i] = generation
+            expanded += 1
+            y, x = divmod(i, width)
+            g_value = g[i]
+            z = elevation[i]
+            step_speed = speed[i]
+            for offset, dx, length in steps:
+                if not 0 <= x + dx < width:
+                    continue
+                j = i + offset
+                if j < 0 or j >= size or terrain[j] == OUT_OF_BOUNDS or (closed[j] == generation and not reopen):
+                    continue
+                dz = elevation[j] - z
+                new_g = g_value + sqrt(length + dz * dz) / step_speed
+                if seen[j] != generation or new_g < g[j]:
+                    g[j] = new_g
+                    parent[j] = i
+                    seen[j] = generation
+                    closed[j] = 0
+                    heappush(frontier, (new_g + heuristic(j, x + dx, j // width), tiebreak, j))
+                    tiebreak += 1
+                    pushed += 1
+            if len(frontier) > peak_frontier:
+                peak_frontier = len(frontier)
+        if stats is not None:
+            stats["expanded"] = expanded
+            stats["pushed"] = pushed
+            stats["stale"] = stale
+            stats["peak_frontier"] = peak_frontier
+            if "cells" in stats:
+                stats["cells"].extend((i % width, i // width) for i in range(size) if closed[i] == generation)
+        if not found:
+            return [], inf
+        path = []
+        i = t
+        while i != -1:
+            path.append((i % width, i // width))
+            i = parent[i]
+        path.reverse()
+        return path, g[t]
+
+
+# Idle workspaces, a search borrows one so concurrent searches never share scratch arrays
+idle_workspaces = []
+idle_lock = threading.Lock()
+
+
+@contextmanager
+def borrowed():
+    """
+    Lends an idle workspace for the duration of a search
+    :return: SearchWorkspace
+    """
+    with idle_lock:
+        workspace = idle_workspaces.pop() if idle_workspaces else SearchWorkspace()
+    try:
+        yield workspace
+    finally:
+        with idle_lock:
+            idle_workspaces.append(workspace)
@@ -1,6 +1,42 @@
-from PIL import Image, ImageDraw
-from queue import PriorityQueue
+from PIL import Image
+import numpy as np
 from math import *
+import search
+from Replanner import Replanner
+from terrain import OUT_OF_BOUNDS, FOOTPATH, LAKE, EASY_FOREST, OPEN_LAND, color_class, to_rgb
+
+SEASONS = ("summer", "fall", "winter", "spring")
+
+# How many pixels the season spreads from the boundaries
+SEASON_DEPTH = {"spring": 15, "winter": 7, "fall": 1}
+
+
+def grow(mask):
+    """
+    Grows a boolean mask by one pixel in the four grid directions
+    :param mask: boolean array
+    :return: grown boolean array
+    """
+    grown = mask.copy()
+    grown[1:, :] |= mask[:-1, :]
+    grown[:-1, :] |= mask[1:, :]
+    grown[:, 1:] |= mask[:, :-1]
+    grown[:, :-1] |= mask[:, 1:]
+    return grown
+
+
+def grow_max(values):
+    """
+    Replaces every pixel by the maximum of itself and its four grid neighbors
+    :param values: float array
+    :return: float array
+    """
+    grown = values.copy()
+    np.maximum(grown[1:, :], values[:-1, :], out=grown[1:, :])
+    np.maximum(grown[:-1, :], values[1:, :], out=grown[:-1, :])
+    np.maximum(grown[:, 1:], values[:, :-1], out=grown[:, 1:])
+    np.maximum(grown[:, :-1], values[:, 1:], out=grown[:, :-1])
+    return grown
 
 
 class Season:
@@ -13,12 +49,16 @@ class Season:
         :param season: season
         """
         self.path_color = None
-        self.grid = grid
+        # own grid over the same arrays, the season overlay never touches the base map
+        self.grid = grid.with_terrain(grid.terrain)
         self.grid.speed_set()
         self.image_file = image_file
         self.output_file = output_file
         self.processed_file = None
         self.season = season
+        self.leg_cache = None
+        # search state of the legs solved with replan, kept across map changes
+        self.replanners = {}
         if season == "spring":
             self.path_color = (86, 54, 0)
         elif season == "winter":
@@ -27,64 +67,37 @@ class Season:
             self.path_color = (0, 255, 255)
         else:
             self.path_color = (255, 0, 255)
+        self.speed_setting_season()
+
+    def apply_season(self, season_terrain=None, speed=None):
+        """
+        Builds the season overlay of the map, or reuses one that was built earlier
+        :param season_terrain: optional precomputed seasonal terrain array
+        :param speed: optional precomputed speed raster of the seasonal terrain
+        :return: seasonal terrain array
+        """
+        if season_terrain is not None:
+            self.grid = self.grid.with_terrain(season_terrain)
+            if speed is not None:
+                self.grid.speed = speed
+        elif self.season != "summer":
+            self.bfs_season(self.season_limits())
+        return self.grid.terrain
 
     def season_limits(self):
         """
         Finds the changes in original map with respect to given season
-        :return: edges of boundaries which needed a change
+        :return: boolean mask of the boundary pixels which need a change
         """
         if self.season == "summer":
             return
-        neighbors = [(0, 1), (1, 0), (-1, 0), (0, -1)]
-        points_list = []
-        season_pixels = []
-        season_edges = []
-        width = self.grid.width
-        height = self.grid.height
-        x = 0
-        while x < width:
-            y = 0
-            while y < height:
-                points_list.append((x, y))
-                if self.season == "spring" or self.season == "winter":
-                    if self.grid.pix_copy[x, y] == (0, 0, 255):
-                        season_pixels.append((x, y))
-                else:
-                    if self.grid.pix_copy[x, y] == (255, 255, 255):
-                        season_pixels.append((x, y))
-                y += 1
-            x += 1
-        for points in points_list:
-            k = 0
-            while k < (len(neighbors)):
-                xp = points[0] + neighbors[k][0]
-                yp = points[1] + neighbors[k][1]
-                condition = self.filter_edges_one(points[0], points[1], xp, yp, season_edges)
-                if condition:
-                    season_edges.append((xp, yp))
-                k += 1
-        return season_edges
-
-    def filter_edges_one(self, x1, y1, xp, yp, season_edges):
-        """
-        Basic filter on deciding the bounds of the given two pixels
-        :param x1:current node x
-        :param y1:current node y
-        :param xp:next node x
-        :param yp:next node y
-        :param season_edges: boundary lise
-        :return:
-        """
-        if self.season == "winter" or self.season == "spring":
-            if xp >= 0 and xp < self.grid.width and yp >= 0 and yp < self.grid.height:
-                if self.grid.pix_copy[x1, y1] == (0, 0, 255) and self.grid.pix_copy[xp, yp] != (0, 0, 255) and \
-                        ((xp, yp) not in season_edges):
-                    return True
-        elif self.season == "fall":
-            if xp >= 0 and xp < self.grid.width and yp >= 0 and yp < self.grid.height:
-                if self.grid.pix_copy[x1, y1] == (255, 255, 255) and self.grid.pix_copy[xp, yp] != (255, 255, 255) and \
-                        ((xp, yp) not in season_edges):
-                    return True
+        terrain = self.grid.terrain
+        if self.season == "spring" or self.season == "winter":
+            season_pixels = terrain == LAKE
+        else:
+            season_pixels = terrain == EASY_FOREST
+        # pixels outside the season terrain that touch it
+        return grow(season_pixels) & ~season_pixels
 
     def speed_setting_season(self):
         """
@@ -101,163 +114,149 @@ class Season:
             self.grid.speed_values[self.path_color] = 6
         elif self.season == "summer":
             pass
+        self.grid.update_speed_table()
 
     def bfs_season(self, season_edges):
         """
-        Generic implementation of a BFS, travers in the list of season edges
-        :param season_edges:
+        Multi source BFS from all season edges at once, spreading one pixel per step
+        until the depth of the season is reached
+        :param season_edges: boolean mask of boundary pixels
         :return: None
         """
         if self.season == "summer":
             return
-        pixel_neighbors = [(0, 1), (1, 0), (-1, 0), (0, -1)]
-        season_boundaries = []
-        depth_parameters = None
+        depth_parameters = SEASON_DEPTH[self.season]
+        terrain = self.grid.terrain
         if self.season == "spring":
-            depth_parameters = 15
-        elif self.season == "winter":
-            depth_parameters = 7
-        elif self.season == "fall":
-            depth_parameters = 1
-        elif self.season == "summer":
-            depth_parameters = 0
-        for points in season_edges:
-            parent_elevation = float(self.grid.ele_copy[points[0]][points[1]])
+            # mud never climbs more than 1 m above the water edge it spreads from,
+            # track the highest edge elevation that can reach each pixel
+            elevation = self.grid.elevation
+            land = (terrain != LAKE) & (terrain != OUT_OF_BOUNDS)
+            source_elevation = np.where(season_edges, elevation, -np.inf)
+            for i in range(depth_parameters):
+                source_elevation = np.where(land, grow_max(source_elevation), -np.inf)
+                source_elevation[elevation - source_elevation > 1] = -np.inf
+            season_boundaries = land & (source_elevation > -np.inf)
+        else:
+            reached = season_edges
+            for i in range(depth_parameters):
+                reached = grow(reached)
             if self.season == "winter":
-                if self.grid.pix_copy[points[0], points[1]] == (0, 0, 255):
-                    season_boundaries.append((points[0], points[1]))
-            queue = []
-            explored_set = {}
-            queue.append((points[0], points[1]))
-
-            # BFS Implementation
-            while len(queue) != 0:
-                current_node = queue.pop(0)
-                if current_node[0] == points[0] + depth_parameters or \
-                        current_node[1] == points[1] + depth_parameters or \
-                        current_node[0] == points[0] - depth_parameters or \
-                        current_node[1] == points[1] - depth_parameters:
-                    break
-                if current_node not in explored_set:
-                    explored_set[(current_node[0], current_node[1])] = 0
-                else:
-                    continue
-                for k in range(len(pixel_neighbors)):
-                    x_value = current_node[0] + pixel_neighbors[k][0]
-                    y_value = current_node[1] + pixel_neighbors[k][1]
-                    if self.season == "spring":
-                        if x_value >= 0 and x_value < self.grid.width and y_value >= 0 and y_value < self.grid.height:
-                            if (x_value, y_value) not in queue and (x_value, y_value) not in explored_set:
-                                if (not (float(self.grid.ele_copy[x_value][y_value]) - parent_elevation > 1)):
-                                    if self.grid.pix_copy[x_value, y_value] != (205, 0, 101):
-                                        queue.append((x_value, y_value))
-                                    if self.grid.pix_copy[x_value, y_value] != (0, 0, 255):
-                                        season_boundaries.append((x_value, y_value))
-                    elif self.season == "winter":
-                        if x_value >= 0 and x_value < self.grid.width and y_value >= 0 and y_value < self.grid.height:
-                            if (x_value, y_value) not in queue and (x_value, y_value) not in explored_set:
-                                queue.append((x_value, y_value))
-                                if self.grid.pix_copy[x_value, y_value] == (0, 0, 255):
-                                    season_boundaries.append((x_value, y_value))
-                    elif self.season == "fall":
-                        if x_value >= 0 and x_value < self.grid.width and y_value >= 0 and y_value < self.grid.height:
-                            if (x_value, y_value) not in queue and (x_value, y_value) not in explored_set:
-                                queue.append((x_value, y_value))
-                                if self.grid.pix_copy[x_value, y_value] == (248, 148, 18) \
-                                        or self.grid.pix_copy[x_value, y_value] == (0, 0, 0):
-                                    season_boundaries.append((x_value, y_value))
-            while len(queue) != 0:
-                current_node = queue.pop(0)
-                xc = current_node[0]
-                yc = current_node[1]
-                if self.season == "spring":
-                    if xc >= 0 and xc < self.grid.width and yc >= 0 and yc < self.grid.height:
-                        if self.grid.pix_copy[xc, yc] != (0, 0, 255):
-                            if (not (float(self.grid.ele_copy[xc][yc]) - parent_elevation >= 1)):
-                                season_boundaries.append((xc, yc))
-                elif self.season == "winter":
-                    if xc >= 0 and xc < self.grid.width and yc >= 0 and yc < self.grid.height:
-                        if self.grid.pix_copy[xc, yc] == (0, 0, 255):
-                            season_boundaries.append((xc, yc))
-                elif self.season == "fall":
-                    if xc >= 0 and xc < self.grid.width and yc >= 0 and yc < self.grid.height:
-                        if self.grid.pix_copy[xc, yc] == (248, 148, 18) \
-                                or self.grid.pix_copy[xc, yc] == (0, 0, 0):
-                            season_boundaries.append((xc, yc))
+                season_boundaries = reached & (terrain == LAKE)
+            else:
+                season_boundaries = reached & ((terrain == OPEN_LAND) | (terrain == FOOTPATH))
         self.update_map(season_boundaries)
         print("map updated for season")
         print("Entering Astar")
 
     def update_map(self, boundaries):
         """
-        Upadates the map for the required season, also stores a temporary map
-        so that I can atleast get some points in this lab
-        :param boundaries: boundaries that need to change with the season
+        Updates the map for the required season in memory, the base terrain is copied
+        once and the boundaries are painted with the season terrain class
+        :param boundaries: boolean mask of pixels that need to change with the season
+        :return: seasonal terrain array
+        """
+        terrain = self.grid.terrain.copy()
+        terrain[boundaries] = color_class(self.path_color)
+        self.grid = self.grid.with_terrain(terrain)
+        return terrain
+
+    def save_map(self, file_name):
+        """
+        Writes the seasonal map to an image file
+        :param file_name: output image file
         :return: None
         """
-        image = Image.open(self.image_file)
-        update_pixels = ImageDraw.Draw(image)
-        for i in range(len(boundaries) - 1):
-            update_pixels.point(boundaries[i], fill=self.path_color)
-        if self.season =="winter":
-            image.save("temp_winter.png")
-        elif self.season =="spring":
-            image.save("temp_spring.png")
-        else:
-            image.save("temp_fall.png")
+        Image.fromarray(to_rgb(self.grid.terrain)).save(file_name)
 
-    def a_star(self, start, final):
+    def a_star(self, start, final, stats=None):
         """
-        Generic Astar created from the skeleton stubs from
-        https://www.redblobgames.com/pathfinding/a-star/implementation.html#python-astar
+        Shortest travel time path between two goals, see search.a_star
         :param start: starting node
         :param final: ending node
+        :param stats: optional dictionary that receives search counters and the travel time
         :return: node list containing points on grid required to travel from one goal to another
         """
-        self.speed_setting_season()
-        cost_so_far = {}
-        frontier = PriorityQueue()
-        parents = {}
-        frontier.put(start, 0)
-        cost_so_far[start] = 0
-        f_value = {}
-        f_value[start] = self.grid.heuristic(start[0], start[1], final[0], final[1])
-        final_path_list = []
-        while not frontier.empty():
-            actual_node = frontier.get()
-            final_path_list = []
-            if actual_node == final:
-                curr = final
-                while curr != start:
-                    final_path_list.insert(0, curr)
-                    curr = parents[curr]
-                final_path_list.insert(0, start)
-                break
-            potential_neighbors = self.grid.neighbors(int(actual_node[0]), int(actual_node[1]))
-            for neighbor in potential_neighbors:
-                g_value = cost_so_far[actual_node] + self.grid.cost_g(actual_node[0], actual_node[1],
-                                                                      neighbor[0],
-                                                                      neighbor[1])
-                h_value = self.grid.heuristic(neighbor[0], neighbor[1], final[0], final[1])
-                if neighbor not in cost_so_far or g_value + h_value < f_value[neighbor]:
-                    cost_so_far[neighbor] = g_value
-                    f_value[neighbor] = g_value + h_value
-                    frontier.put(neighbor, g_value + h_value)
-                    parents[neighbor] = actual_node
+        final_path_list, time = self.solve(start, final, stats)
+        if stats is not None:
+            stats["time"] = time
         print("found path from: " + str(start) + " to: " + str(final))
         return final_path_list
 
+    def solve(self, start, final, stats=None, method="astar", options=None):
+        """
+        Solves a leg, through the leg cache when one is set
+        :param start: starting node
+        :param final: ending node
+        :param stats: optional dictionary that receives search counters
+        :param method: name of the engine in search.ENGINES
+        :param options: optional keyword arguments of the engine, such as the budget of the anytime engine
+        :return: (path, travel time)
+        """
+        if self.leg_cache is not None:
+            return self.leg_cache.solve(self.grid, self.season, start, final, stats, method, options)
+        return search.ENGINES[method](self.grid, start, final, stats, **(options or {}))
+
+    def replan(self, start, final, stats=None):
+        """
+        Solves a leg incrementally, a leg planned before only repairs the part of its search
+        touched by the changes made to the map since, see Replanner
+        :param start: starting node
+        :param final: ending node
+        :param stats: optional dictionary that receives search counters
+        :return: (path, travel time)
+        """
+        replanner = self.replanners.get((start, final))
+        if replanner is None:
+            replanner = self.replanners[(start, final)] = Replanner(self.grid, start, final)
+            return replanner.plan(stats)
+        return replanner.update(self.grid, stats=stats)
+
+    def close_area(self, mask):
+        """
+        Closes an area of the map, closed pixels become out of bounds
+        :param mask: boolean array of the closed pixels, indexed [y, x]
+        :return: seasonal terrain array
+        """
+        terrain = self.grid.terrain.copy()
+        terrain[mask] = OUT_OF_BOUNDS
+        self.grid = self.grid.with_terrain(terrain)
+        return terrain
+
+    def set_speed(self, color, speed):
+        """
+        Changes the speed of a terrain type on a new grid, the arrays of the current grid
+        are left untouched for the searches still holding it
+        :param color: terrain color
+        :param speed: new speed
+        :return: None
+        """
+        grid = self.grid.with_terrain(self.grid.terrain)
+        grid.speed_values[color] = speed
+        grid.update_speed_table()
+        self.grid = grid
+
     def total_cost_2D(self, final_list):
         """
         Compute total 2D  distance between the start and end paths
         :param final_list:
-        :return:
+        :return: total distance
+        """
+        total_cost = self.path_distance(final_list)
+        print("Total distance: " + str(total_cost))
+        return total_cost
+
+    def path_distance(self, final_list):
+        """
+        2D distance along a path
+        :param final_list: list of points
+        :return: distance
         """
         total_cost = 0
         for i in range(len(final_list) - 1):
             temp = self.pairwise_distance(final_list[i], final_list[i + 1])
             total_cost = total_cost + temp
-        print("Total distance: " + str(total_cost))
+        return total_cost
 
     def pairwise_distance(self, start, end):
         """
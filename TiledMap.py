@@ -0,0 +1,265 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from main import GridWithWeights, finite_json, project1, prepare_season
+from Season import Season, SEASONS
+
+"""
+Tiled maps for terrain larger than memory. The terrain classes and elevations are cut into
+square tiles stored as .npy files next to a map.json describing the map. A TiledGrid memory maps
+a tile the first time a search reaches it and keeps at most max_bytes of tiles, dropping the
+least recently used ones, while offering the interface of GridWithWeights to the engines that
+work through it (astar, bidirectional and anytime).
+"""
+
+TILE_VERSION = 1
+TILE_LAYERS = ("terrain", "elevation")
+
+
+def write_tiles(terrain, elevation, tile_dir, tile_size=256, season="summer"):
+    """
+    Cuts a map into tiles, the directory only appears once every tile is written
+    :param terrain: terrain class array, indexed [y, x], may be memory mapped
+    :param elevation: elevation array of the same shape
+    :param tile_dir: output directory, replaced if it exists
+    :param tile_size: side of a tile in pixels
+    :param season: season the terrain classes belong to
+    :return: None
+    """
+    height, width = terrain.shape
+    digest = hashlib.sha256()
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(tile_dir)), prefix=".tiles-")
+    try:
+        for ty in range(0, height, tile_size):
+            for tx in range(0, width, tile_size):
+                for name, array, dtype in (("terrain", terrain, np.uint8), ("elevation", elevation, np.float32)):
+                    tile = np.ascontiguousarray(array[ty:ty + tile_size, tx:tx + tile_size], dtype=dtype)
+                    digest.update(tile.tobytes())
+                    np.save(os.path.join(temp_dir, "%s_%d_%d.npy" % (name, tx // tile_size, ty // tile_size)), tile)
+        with open(os.path.join(temp_dir, "map.json"), "w") as f:
+            json.dump({"version": TILE_VERSION, "width": width, "height": height, "tile_size": tile_size,
+                       "season": season, "digest": digest.hexdigest()[:32]}, f)
+        if os.path.isdir(tile_dir):
+            shutil.rmtree(tile_dir)
+        os.rename(temp_dir, tile_dir)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+
+def build_tiles(image_file, elevation_file, tile_dir, tile_size=256, season="summer"):
+    """
+    Tiles the seasonal map of an image and elevation file
+    :param image_file: terrain image file
+    :param elevation_file: elevation file
+    :param tile_dir: output directory
+    :param tile_size: side of a tile in pixels
+    :param season: season painted into the tiles
+    :return: None
+    """
+    drive = project1(image_file, elevation_file, None, season, None)
+    drive_season = prepare_season(drive, season)
+    write_tiles(drive_season.grid.terrain, drive_season.grid.elevation, tile_dir, tile_size, season)
+
+
+class TileStore:
+    def __init__(self, tile_dir, max_bytes=64 * 1024 * 1024):
+        """
+        Memory maps the tiles of a map on demand and drops the least recently used ones
+        once max_bytes of tiles are held
+        :param tile_dir: directory written by write_tiles
+        :param max_bytes: budget of the tiles held at once
+        """
+        with open(os.path.join(tile_dir, "map.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != TILE_VERSION:
+            raise ValueError("unsupported tile version in " + tile_dir)
+        self.tile_dir = tile_dir
+        self.width = meta["width"]
+        self.height = meta["height"]
+        self.tile_size = meta["tile_size"]
+        self.season = meta["season"]
+        self.digest = meta["digest"]
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.bytes = 0
+        self.loads = 0
+        self.lock = threading.Lock()
+
+    def tile(self, name, tx, ty):
+        """
+        Tile of a layer, memory mapped on a miss
+        :param name: layer name, terrain or elevation
+        :param tx: tile column
+        :param ty: tile row
+        :return: read only array of the tile
+        """
+        key = (name, tx, ty)
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                return tile
+        tile = np.load(os.path.join(self.tile_dir, "%s_%d_%d.npy" % key), mmap_mode="r")
+        with self.lock:
+            if key not in self.tiles:
+                self.tiles[key] = tile
+                self.bytes += tile.nbytes
+                self.loads += 1
+            self.tiles.move_to_end(key)
+            # the tile just loaded always stays
+            while self.bytes > self.max_bytes and len(self.tiles) > 1:
+                evicted_key, evicted = self.tiles.popitem(last=False)
+                self.bytes -= evicted.nbytes
+            return self.tiles[key]
+
+
+class TileLayer:
+    def __init__(self, store, name):
+        """
+        One layer of a tiled map seen as an array with item(y, x)
+        :param store: TileStore
+        :param name: layer name
+        """
+        self.store = store
+        self.name = name
+        self.shape = (store.height, store.width)
+        # most lookups fall in the tile of the previous one
+        self.last = (None, None)
+
+    def item(self, y, x):
+        """
+        Value of a pixel
+        :param y: y coordinate
+        :param x: x coordinate
+        :return: python scalar
+        """
+        size = self.store.tile_size
+        key = (x // size, y // size)
+        last_key, tile = self.last
+        if key != last_key:
+            tile = self.store.tile(self.name, key[0], key[1])
+            self.last = (key, tile)
+        return tile.item(y % size, x % size)
+
+
+class SpeedLayer:
+    def __init__(self, terrain, speed_table):
+        """
+        Speed of every pixel looked up from the terrain layer
+        :param terrain: TileLayer of the terrain classes
+        :param speed_table: speed lookup table indexed by terrain class
+        """
+        self.terrain = terrain
+        self.shape = terrain.shape
+        self.speeds = speed_table.tolist()
+
+    def item(self, y, x):
+        """
+        Speed of a pixel
+        :param y: y coordinate
+        :param x: x coordinate
+        :return: speed
+        """
+        return self.speeds[self.terrain.item(y, x)]
+
+
+class TiledGrid(GridWithWeights):
+    def __init__(self, store, goal_points=None):
+        """
+        Weighted grid over a tiled map
+        :param store: TileStore
+        :param goal_points: points to travel
+        """
+        super().__init__(store.width, store.height, TileLayer(store, "terrain"), TileLayer(store, "elevation"),
+                         goal_points if goal_points is not None else [])
+        self.store = store
+
+    def speed_raster(self):
+        """
+        Speeds looked up per pixel instead of a full raster
+        :return: SpeedLayer
+        """
+        return SpeedLayer(self.terrain, self.speed_table)
+
+    def fingerprint(self):
+        """
+        Content hash of the tiles, computed when they were written, and of the speeds
+        :return: hex digest
+        """
+        if self.cost_fingerprint is None:
+            digest = hashlib.sha256(self.store.digest.encode())
+            digest.update(np.ascontiguousarray(self.speed_table).tobytes())
+            self.cost_fingerprint = digest.hexdigest()[:32]
+        return self.cost_fingerprint
+
+    def with_terrain(self, terrain):
+        """
+        Creates a grid with copied speeds over the same tiles
+        :param terrain: terrain layer of this grid, other terrain cannot be tiled on the fly
+        :return: weighted grid
+        """
+        if terrain is not self.terrain:
+            raise ValueError("a tiled map reads its terrain from the tiles, use write_tiles for new terrain")
+        grid = type(self)(self.store, self.goal_points)
+        grid.speed_values = dict(self.speed_values)
+        if self.speed_table is not None:
+            grid.update_speed_table()
+        return grid
+
+
+def open_season(tile_dir, max_bytes=64 * 1024 * 1024):
+    """
+    Seasonal map over tiles, with the speeds of the season the tiles were written for
+    :param tile_dir: directory written by write_tiles
+    :param max_bytes: budget of the tiles held at once
+    :return: Season
+    """
+    store = TileStore(tile_dir, max_bytes)
+    grid = TiledGrid(store)
+    drive_season = Season(grid, None, None, store.season)
+    # the season is already painted into the tiles
+    drive_season.apply_season(season_terrain=drive_season.grid.terrain)
+    return drive_season
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds tiled maps and routes over them")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="cut a map into tiles")
+    build.add_argument("image_file", help="terrain image")
+    build.add_argument("elevation_file", help="elevation file")
+    build.add_argument("tile_dir", help="output directory")
+    build.add_argument("--tile-size", type=int, default=256)
+    build.add_argument("--season", choices=SEASONS, default="summer")
+    route = commands.add_parser("route", help="route a course over a tiled map")
+    route.add_argument("tile_dir", help="directory of the tiles")
+    route.add_argument("path_file", help="control points to visit in order")
+    route.add_argument("--max-mb", type=float, default=64, help="budget of the tiles held at once")
+    route.add_argument("--method", default="astar", choices=("astar", "bidirectional", "anytime"))
+    args = parser.parse_args()
+    if args.command == "build":
+        build_tiles(args.image_file, args.elevation_file, args.tile_dir, args.tile_size, args.season)
+        return
+    drive_season = open_season(args.tile_dir, int(args.max_mb * 1024 * 1024))
+    with open(args.path_file) as f:
+        points = [(int(line.split()[0]), int(line.split()[1])) for line in f if line.strip()]
+    legs = []
+    for start, final in zip(points, points[1:]):
+        stats = {}
+        path, time = drive_season.solve(start, final, stats, args.method)
+        legs.append({"start": start, "end": final, "time": time,
+                     "distance": drive_season.path_distance(path), "expanded": stats.get("expanded")})
+    print(json.dumps(finite_json({"season": drive_season.season, "legs": legs,
+                                  "time": sum(leg["time"] for leg in legs),
+                                  "tile_loads": drive_season.grid.store.loads}), allow_nan=False))
+
+
+if __name__ == "__main__":
+    main()
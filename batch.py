@@ -0,0 +1,178 @@
+import argparse
+import json
+from time import perf_counter
+from LegCache import LegCache
+from MapCache import MapCache
+from main import finite_json, project1, prepare_season
+from parallel import solve_leg, solve_legs
+from Profiler import Profiler, stage
+from render import Renderer
+from Season import SEASONS
+from search import ENGINES, is_exact
+
+"""
+Batch course processing. The terrain and elevation are read once, every season used by the
+manifest is built once and all legs of a season are scheduled together across the workers.
+
+Manifest lines are "path_file season [output_image]", blank lines and # comments are skipped.
+Jobs naming the same output image are drawn together on it, over the map of the first of them.
+"""
+
+
+def read_manifest(manifest_file):
+    """
+    Reads the jobs of a manifest
+    :param manifest_file: manifest file
+    :return: list of job dictionaries
+    """
+    jobs = []
+    with open(manifest_file) as f:
+        for line in f:
+            state = line.split("#")[0].split()
+            if not state:
+                continue
+            if len(state) not in (2, 3):
+                raise ValueError("manifest line needs a path file, a season and an optional output: " + line)
+            if state[1] not in SEASONS:
+                raise ValueError("unknown season in manifest: " + state[1])
+            jobs.append({"path_file": state[0], "season": state[1],
+                         "output": state[2] if len(state) == 3 else None})
+    return jobs
+
+
+def read_points(path_file):
+    """
+    Reads the control points of a course
+    :param path_file: path file
+    :return: list of (x, y)
+    """
+    drive = project1(None, None, path_file, None, None)
+    return [(int(point[0]), int(point[1])) for point in drive.read_goal()]
+
+
+def run_batch(image_file, elevation_file, jobs, workers=None, cache_dir=None, leg_store=None, method="astar",
+              renderer=None, profiler=None):
+    """
+    Routes every job of a manifest
+    :param image_file: terrain image file
+    :param elevation_file: elevation file
+    :param jobs: list of job dictionaries
+    :param workers: solve the legs in this many processes, sequentially if not given
+    :param cache_dir: optional directory of the preprocessed map cache
+    :param leg_store: optional sqlite file persisting solved legs between runs
+    :param method: name of the engine in search.ENGINES
+    :param renderer: optional Renderer, outputs are drawn in red by default
+    :param profiler: optional Profiler recording the stages and the solved legs
+    :return: JSON serializable results
+    """
+    began = perf_counter()
+    drive = project1(image_file, elevation_file, None, None, None)
+    cache = MapCache(cache_dir) if cache_dir else None
+    leg_cache = LegCache(store_file=leg_store)
+    if renderer is None:
+        renderer = Renderer()
+    seasons = {}
+    for job in jobs:
+        if job["season"] not in seasons:
+            seasons[job["season"]] = prepare_season(drive, job["season"], cache, hierarchy=method == "hpa",
+                                                     landmarks=method == "alt", profiler=profiler)
+        job["points"] = read_points(job["path_file"])
+    for season, drive_season in seasons.items():
+        grid = drive_season.grid
+        season_jobs = [job for job in jobs if job["season"] == season]
+        legs = [leg for job in season_jobs for leg in zip(job["points"], job["points"][1:])]
+        solved = {}
+        for leg in legs:
+            cached = leg_cache.get(grid, season, leg[0], leg[1])
+            if cached is not None:
+                solved[leg] = (cached[0], cached[1], {"expanded": 0, "seconds": 0.0, "cached": True})
+        # legs shared by several courses are solved once
+        missing = list(dict.fromkeys(leg for leg in legs if leg not in solved))
+        trace = profiler is not None and profiler.heatmap
+        with stage(profiler, "search", season=season, legs=len(missing), method=method):
+            if workers is not None and workers > 1 and len(missing) > 1:
+                results = solve_legs(grid, missing, workers, method, trace=trace)
+            elif profiler is not None:
+                results = []
+                for leg in missing:
+                    record = {}
+                    with profiler.measure(record):
+                        results.append(solve_leg(leg, grid, method, trace=trace))
+                    results[-1][2].update(record)
+            else:
+                results = [solve_leg(leg, grid, method) for leg in missing]
+        for leg, result in zip(missing, results):
+            if profiler is not None:
+                profiler.record_leg(grid, leg[0], leg[1], dict(result[2], time=result[1]), season=season,
+                                    method=method)
+                result[2].pop("cells", None)
+                result[2].pop("peak_bytes", None)
+            solved[leg] = result
+            if result[0] and is_exact(method, result[2]):
+                leg_cache.put(grid, season, leg[0], leg[1], result[0], result[1])
+        reported = set()
+        for job in season_jobs:
+            job_legs = []
+            leg_paths = []
+            for start, final in zip(job["points"], job["points"][1:]):
+                path, time, stats = solved[(start, final)]
+                if (start, final) in reported:
+                    stats = {"expanded": 0, "seconds": 0.0, "cached": True}
+                reported.add((start, final))
+                leg_paths.append(path)
+                job_legs.append({"start": start, "end": final, "time": time,
+                                 "distance": drive_season.path_distance(path),
+                                 "expanded": stats["expanded"], "seconds": stats["seconds"],
+                                 "cached": stats.get("cached", False)})
+                for name in ("expanded_forward", "expanded_reverse"):
+                    if name in stats:
+                        job_legs[-1][name] = stats[name]
+            renderer.add(job["output"], drive_season.grid.terrain, leg_paths, (255, 0, 0))
+            job["result"] = {"path_file": job["path_file"], "season": season, "output": job["output"],
+                             "legs": job_legs,
+                             "time": sum(leg["time"] for leg in job_legs),
+                             "distance": sum(leg["distance"] for leg in job_legs),
+                             "expanded": sum(leg["expanded"] for leg in job_legs),
+                             "seconds": sum(leg["seconds"] for leg in job_legs)}
+    leg_cache.close()
+    rendering = perf_counter()
+    with stage(profiler, "rendering"):
+        renderer.render()
+    return {"jobs": [job["result"] for job in jobs], "seconds": perf_counter() - began,
+            "render_seconds": perf_counter() - rendering}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Routes many courses and seasons in one run")
+    parser.add_argument("image_file", help="terrain image")
+    parser.add_argument("elevation_file", help="elevation file")
+    parser.add_argument("manifest_file", help="lines of: path_file season [output_image]")
+    parser.add_argument("results_file", help="JSON results")
+    parser.add_argument("--workers", type=int, help="solve the legs in this many processes")
+    parser.add_argument("--cache-dir", help="directory of the preprocessed map cache")
+    parser.add_argument("--leg-store", help="sqlite file persisting solved legs between runs")
+    parser.add_argument("--method", default="astar", choices=sorted(ENGINES), help="search engine, hpa is approximate")
+    parser.add_argument("--no-render", action="store_true", help="only compute the routes, write no images")
+    parser.add_argument("--thumbnail", type=int, help="also write thumbnails with this longest side")
+    parser.add_argument("--color-legs", action="store_true", help="draw every leg in its own colour")
+    parser.add_argument("--profile", help="write stage timings and per leg search counters to this JSON lines file")
+    parser.add_argument("--memory", action="store_true", help="also trace the peak memory of every stage and leg")
+    parser.add_argument("--heatmap", help="write an image of the expanded cells of all seasons to this file")
+    args = parser.parse_args()
+    profiler = None
+    if args.profile or args.memory or args.heatmap:
+        profiler = Profiler(args.profile, args.memory, args.heatmap is not None)
+    results = run_batch(args.image_file, args.elevation_file, read_manifest(args.manifest_file),
+                        args.workers, args.cache_dir, args.leg_store, args.method,
+                        Renderer(not args.no_render, args.thumbnail, args.color_legs), profiler)
+    if profiler is not None:
+        if args.heatmap:
+            profiler.save_heatmap(args.heatmap)
+        profiler.close()
+    with open(args.results_file, "w") as f:
+        json.dump(finite_json(results), f, indent=2, allow_nan=False)
+    print("routed " + str(len(results["jobs"])) + " jobs in " + str(results["seconds"]) + " s")
+
+
+if __name__ == "__main__":
+    main()
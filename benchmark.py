@@ -0,0 +1,480 @@
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from itertools import permutations
+from math import inf, isinf
+from time import perf_counter
+import numpy as np
+from PIL import Image
+from batch import read_points
+from course import travel_time_matrix, route_cost, held_karp, heuristic_order
+from elevation import write_elevation
+from main import project1, prepare_season, driver_project
+from Profiler import Profiler
+from render import Renderer
+from Season import SEASONS
+from search import ENGINES, APPROXIMATE_ENGINES, a_star, dijkstra
+from terrain import OUT_OF_BOUNDS, TERRAIN_COLORS, to_rgb
+
+"""
+Benchmark and regression suite. Every course is routed under every season through the
+driver_project pipeline, on the bundled map and on synthetic larger maps made by tiling it, and
+the throughput, per leg latency percentiles, nodes expanded and peak memory of each run are
+reported. Results can be stored as a baseline and later runs compared against it, the travel
+times of the engines in search.ENGINES are checked against a reference Dijkstra, legs replanned
+through map changes against a fresh A* and the course order heuristic against Held-Karp.
+"""
+
+COURSES = ("path1.txt", "path2.txt", "path3.txt")
+PERCENTILES = (50, 90, 99)
+# Legs checked besides those of the courses, on the bundled map: a start out of bounds that
+# every engine has to step off
+CHECK_LEGS = (((256, 67), (200, 200)),)
+# Changes applied in turn to the map of a replanned leg, each followed by a repair
+REPLAN_CHANGES = ("close", "close", "reopen", "slow", "fast")
+# Half the side of the square closed on the middle of the current path
+CLOSURE_RADIUS = 3
+# Metrics compared against the baseline, with True when a higher value is better
+TRACKED = (("throughput", True), ("latency_p50", False), ("latency_p90", False),
+           ("expanded", False), ("peak_bytes", False))
+
+
+def percentiles(values):
+    """
+    Latency percentiles of a run
+    :param values: latencies in seconds
+    :return: dictionary of latency_p50, latency_p90, latency_p99 and latency_max
+    """
+    values = values or [0.0]
+    result = {"latency_p" + str(q): float(np.percentile(values, q)) for q in PERCENTILES}
+    result["latency_max"] = max(values)
+    return result
+
+
+def mirror_tiles(array, scale):
+    """
+    Tiles a map scale x scale times, mirroring every other tile so neighbouring tiles meet
+    along identical edges and routes can cross the seams
+    :param array: 2D array, indexed [y, x]
+    :param scale: number of tiles along each side
+    :return: array scale times as wide and as high
+    """
+    row = np.concatenate([array if i % 2 == 0 else array[:, ::-1] for i in range(scale)], axis=1)
+    return np.concatenate([row if j % 2 == 0 else row[::-1] for j in range(scale)], axis=0)
+
+
+def mirror_point(point, tile, width, height):
+    """
+    Position of a point of the original map in a tile of mirror_tiles
+    :param point: (x, y) in the original map
+    :param tile: (column, row) of the tile
+    :param width: width of the original map
+    :param height: height of the original map
+    :return: (x, y) in the tiled map
+    """
+    x, y = point
+    if tile[0] % 2:
+        x = width - 1 - x
+    if tile[1] % 2:
+        y = height - 1 - y
+    return tile[0] * width + x, tile[1] * height + y
+
+
+def write_synthetic(image_file, elevation_file, courses, scale, out_dir):
+    """
+    Writes a map scale x scale times larger than the given one, with its courses. The map is
+    cropped to its passable part first so the tiles are connected. Each course is kept in the
+    first tile, then crosses to its mirror image in the opposite corner and runs back through it
+    :param image_file: terrain image file
+    :param elevation_file: elevation file
+    :param courses: list of path files
+    :param scale: number of tiles along each side
+    :param out_dir: directory receiving the files
+    :return: (image file, elevation file, list of path files)
+    """
+    drive = project1(image_file, elevation_file, None, None, None)
+    terrain = drive.read_image()
+    elevation = drive.read_elevation()
+    ys, xs = np.nonzero(terrain != OUT_OF_BOUNDS)
+    x0, y0 = xs.min(), ys.min()
+    terrain = terrain[y0:ys.max() + 1, x0:xs.max() + 1]
+    elevation = elevation[y0:ys.max() + 1, x0:xs.max() + 1]
+    height, width = terrain.shape
+    name = "x" + str(scale)
+    tiled_image = os.path.join(out_dir, name + ".png")
+    tiled_elevation = os.path.join(out_dir, name + ".npy")
+    Image.fromarray(to_rgb(mirror_tiles(terrain, scale))).save(tiled_image)
+    # the pipeline drops the last 5 columns of an elevation file
+    write_elevation(np.pad(mirror_tiles(elevation, scale), ((0, 0), (0, 5)), mode="edge"), tiled_elevation)
+    path_files = []
+    for course in courses:
+        points = [(x - x0, y - y0) for x, y in read_points(course)]
+        far = (scale - 1, scale - 1)
+        points = points + [mirror_point(point, far, width, height) for point in reversed(points)]
+        path_file = os.path.join(out_dir, name + "_" + os.path.basename(course))
+        with open(path_file, "w") as f:
+            f.writelines(str(x) + " " + str(y) + "\n" for x, y in points)
+        path_files.append(path_file)
+    return tiled_image, tiled_elevation, path_files
+
+
+def run_once(image_file, elevation_file, path_file, season, memory=False):
+    """
+    Routes a course through driver_project, without rendering
+    :param image_file: terrain image file
+    :param elevation_file: elevation file
+    :param path_file: path file
+    :param season: season
+    :param memory: trace the peak memory, slows the run down
+    :return: dictionary of the measurements
+    """
+    profiler = Profiler(memory=memory)
+    began = perf_counter()
+    try:
+        with redirect_stdout(io.StringIO()):
+            driver_project(image_file, elevation_file, path_file, season, None,
+                           renderer=Renderer(False), profiler=profiler)
+    finally:
+        profiler.close()
+    seconds = perf_counter() - began
+    legs = [record for record in profiler.records if record["type"] == "leg"]
+    search_seconds = sum(record["seconds"] for record in profiler.records
+                         if record["type"] == "stage" and record["stage"] == "search")
+    result = {"legs": len(legs), "seconds": seconds, "search_seconds": search_seconds,
+              "throughput": len(legs) / search_seconds if search_seconds > 0 else inf,
+              "expanded": sum(leg["expanded"] for leg in legs),
+              "pushed": sum(leg["pushed"] for leg in legs),
+              "peak_frontier": max([leg["peak_frontier"] for leg in legs] or [0]),
+              "time": sum(leg["time"] for leg in legs)}
+    result.update(percentiles([leg["seconds"] for leg in legs]))
+    if memory:
+        result["peak_bytes"] = max(record.get("peak_bytes", 0) for record in profiler.records)
+    return result
+
+
+def run_case(image_file, elevation_file, path_file, season, repeat=3, memory=True):
+    """
+    Measures a course and season, keeping the run with the fastest search. Memory is traced in
+    one extra run so the tracing does not slow down the timed ones
+    :param image_file: terrain image file
+    :param elevation_file: elevation file
+    :param path_file: path file
+    :param season: season
+    :param repeat: number of timed runs
+    :param memory: also measure the peak memory
+    :return: dictionary of the measurements
+    """
+    runs = [run_once(image_file, elevation_file, path_file, season) for _ in range(max(1, repeat))]
+    result = min(runs, key=lambda run: run["search_seconds"])
+    if memory:
+        result["peak_bytes"] = run_once(image_file, elevation_file, path_file, season, memory=True)["peak_bytes"]
+    return result
+
+
+def summarize(cases):
+    """
+    Totals over all cases
+    :param cases: dictionary of case name to measurements
+    :return: dictionary of the totals
+    """
+    legs = sum(case["legs"] for case in cases.values())
+    search_seconds = sum(case["search_seconds"] for case in cases.values())
+    return {"legs": legs, "search_seconds": search_seconds,
+            "throughput": legs / search_seconds if search_seconds > 0 else inf,
+            "expanded": sum(case["expanded"] for case in cases.values()),
+            "peak_bytes": max([case.get("peak_bytes", 0) for case in cases.values()] or [0])}
+
+
+def relative_difference(time, reference):
+    """
+    Relative difference of a travel time from a reference, two unreachable legs agree
+    :param time: travel time
+    :param reference: reference travel time
+    :return: relative difference, inf when only one of them is reachable
+    """
+    if isinf(reference) or isinf(time):
+        return 0.0 if time == reference else inf
+    return abs(time - reference) / max(reference, 1e-12)
+
+
+def check_engines(image_file, elevation_file, courses, seasons, engines, tolerance=1e-6):
+    """
+    Compares the travel time of every leg found by the engines with a reference Dijkstra, the
+    approximate engines only have to be no faster than it
+    :param image_file: terrain image file
+    :param elevation_file: elevation file
+    :param courses: list of path files
+    :param seasons: list of seasons
+    :param engines: names of engines in search.ENGINES
+    :param tolerance: largest relative difference accepted
+    :return: (dictionary of engine to largest relative difference, list of mismatches)
+    """
+    drive = project1(image_file, elevation_file, None, None, None)
+    deviation = {name: 0.0 for name in engines}
+    mismatches = []
+    for season in seasons:
+        with redirect_stdout(io.StringIO()):
+            drive_season = prepare_season(drive, season, hierarchy="hpa" in engines, landmarks="alt" in engines)
+        grid = drive_season.grid
+        legs = list(dict.fromkeys([leg for course in courses
+                                   for leg in zip(read_points(course), read_points(course)[1:])]
+                                  + [leg for leg in CHECK_LEGS
+                                     if all(x < grid.width and y < grid.height for x, y in leg)]))
+        for start, final in legs:
+            reference = dijkstra(grid, start, [final])[final][1]
+            for name in engines:
+                time = ENGINES[name](grid, start, final, {})[1]
+                difference = relative_difference(time, reference)
+                deviation[name] = max(deviation[name], difference)
+                if name in APPROXIMATE_ENGINES and time >= reference * (1 - tolerance):
+                    continue
+                if difference > tolerance:
+                    mismatches.append({"engine": name, "season": season, "start": start, "end": final,
+                                       "time": time, "reference": reference})
+    return deviation, mismatches
+
+
+def change_map(drive_season, change, path, opened, keep):
+    """
+    Applies one of REPLAN_CHANGES to a seasonal map
+    :param drive_season: season object, its grid is replaced
+    :param change: close a square on the middle of the path, reopen the original map, or make
+                   the terrain type in the middle of the path slower or faster
+    :param path: current path of the leg
+    :param opened: grid of the map before any change
+    :param keep: nodes that are never closed, the ends of the leg
+    :return: None
+    """
+    x, y = path[len(path) // 2]
+    if change == "close":
+        mask = np.zeros((drive_season.grid.height, drive_season.grid.width), dtype=bool)
+        mask[max(y - CLOSURE_RADIUS, 0):y + CLOSURE_RADIUS + 1,
+             max(x - CLOSURE_RADIUS, 0):x + CLOSURE_RADIUS + 1] = True
+        for node in keep:
+            mask[node[1], node[0]] = False
+        drive_season.close_area(mask)
+    elif change == "reopen":
+        drive_season.grid = opened
+    else:
+        terrain_class = int(drive_season.grid.terrain[y, x])
+        speed = float(drive_season.grid.speed_table[terrain_class])
+        drive_season.set_speed(TERRAIN_COLORS[terrain_class], speed / 2 if change == "slow" else speed * 3)
+
+
+def check_replanner(image_file, elevation_file, courses, seasons, legs_per_course=3, tolerance=1e-6):
+    """
+    Replans legs through the changes of REPLAN_CHANGES with Season.replan and compares every
+    repaired travel time with a fresh search.a_star on the changed map
+    :param image_file: terrain image file
+    :param elevation_file: elevation file
+    :param courses: list of path files
+    :param seasons: list of seasons
+    :param legs_per_course: number of legs of every course that are replanned
+    :param tolerance: largest relative difference accepted
+    :return: (number of plans compared, list of mismatches)
+    """
+    drive = project1(image_file, elevation_file, None, None, None)
+    plans = 0
+    mismatches = []
+    for season in seasons:
+        legs = list(dict.fromkeys(leg for course in courses
+                                  for leg in list(zip(read_points(course), read_points(course)[1:]))[:legs_per_course]))
+        for start, final in legs:
+            # a fresh season per leg, the changes of one leg never reach the next
+            with redirect_stdout(io.StringIO()):
+                drive_season = prepare_season(drive, season)
+            opened = drive_season.grid
+            path = None
+            for change in ("plan",) + REPLAN_CHANGES:
+                if path is not None:
+                    change_map(drive_season, change, path, opened, (start, final))
+                path, time = drive_season.replan(start, final)
+                reference = a_star(drive_season.grid, start, final)[1]
+                plans += 1
+                if relative_difference(time, reference) > tolerance:
+                    mismatches.append({"season": season, "start": start, "end": final, "change": change,
+                                       "time": time, "reference": reference})
+                if not path:
+                    break
+    return plans, mismatches
+
+
+def check_course_order(image_file, elevation_file, courses, seasons, controls=7, tolerance=1e-6):
+    """
+    Orders the first controls of every course with held_karp, which must match a brute force
+    search over every order, and with heuristic_order, which must never beat held_karp, both
+    with the finish fixed and on an open course
+    :param image_file: terrain image file
+    :param elevation_file: elevation file
+    :param courses: list of path files
+    :param seasons: list of seasons
+    :param controls: number of controls reordered between the start and the finish of a course
+    :param tolerance: largest relative difference accepted
+    :return: (largest relative gap of the heuristic over the optimum, list of failures)
+    """
+    drive = project1(image_file, elevation_file, None, None, None)
+    gap = 0.0
+    failures = []
+    for season in seasons:
+        with redirect_stdout(io.StringIO()):
+            grid = prepare_season(drive, season).grid
+        for course in courses:
+            points = read_points(course)
+            points = points[:controls + 1] + points[-1:]
+            matrix = travel_time_matrix(grid, points)
+            for end in (len(points) - 1, None):
+                free = list(range(1, len(points))) if end is None else list(range(1, end))
+                finish = [] if end is None else [end]
+                optimum = held_karp(matrix, 0, end, free)[1]
+                brute = min(route_cost(matrix, [0] + list(order) + finish) for order in permutations(free))
+                heuristic = heuristic_order(matrix, 0, end)[1]
+                name = os.path.basename(course) + " " + season + (" open" if end is None else "")
+                if relative_difference(optimum, brute) > tolerance:
+                    failures.append("%s: Held-Karp %.6f, brute force %.6f" % (name, optimum, brute))
+                if heuristic < optimum * (1 - tolerance):
+                    failures.append("%s: heuristic %.6f beats Held-Karp %.6f" % (name, heuristic, optimum))
+                gap = max(gap, relative_difference(heuristic, optimum))
+    return gap, failures
+
+
+def compare(results, baseline, threshold=0.1, tolerance=1e-6):
+    """
+    Finds the measurements that got worse than the baseline by more than the threshold, and
+    the routes whose travel time changed
+    :param results: results of this run
+    :param baseline: results of the baseline run
+    :param threshold: relative change tolerated, 0.1 lets a metric get 10% worse
+    :param tolerance: relative change of the travel time tolerated
+    :return: list of regression messages
+    """
+    regressions = []
+    for name, case in results["cases"].items():
+        old = baseline.get("cases", {}).get(name)
+        if old is None:
+            continue
+        for metric, higher_is_better in TRACKED:
+            if metric not in case or not old.get(metric):
+                continue
+            change = (case[metric] - old[metric]) / old[metric]
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append("%s: %s %.4g -> %.4g (%+.1f%%)" % (name, metric, old[metric], case[metric],
+                                                                     100 * change))
+        if abs(case["time"] - old["time"]) > tolerance * max(old["time"], 1e-12):
+            regressions.append("%s: route travel time %.6f -> %.6f" % (name, old["time"], case["time"]))
+    return regressions
+
+
+def run_benchmark(image_file, elevation_file, courses=COURSES, seasons=SEASONS, scales=(2,), repeat=3,
+                  memory=True, engines=None, tolerance=1e-6, replan_legs=3, order_controls=7):
+    """
+    Runs every course under every season on the bundled map and on the synthetic maps
+    :param image_file: terrain image file
+    :param elevation_file: elevation file
+    :param courses: list of path files
+    :param seasons: list of seasons
+    :param scales: tiling factors of the synthetic maps
+    :param repeat: number of timed runs per case
+    :param memory: also measure the peak memory of every case
+    :param engines: engines checked against the reference Dijkstra, all by default, empty to skip
+    :param tolerance: largest relative difference of travel times accepted
+    :param replan_legs: legs of every course replanned through map changes, 0 to skip the check
+    :param order_controls: controls of every course reordered by the order check, 0 to skip it
+    :return: JSON serializable results
+    """
+    cases = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        maps = [("", image_file, elevation_file, list(courses))]
+        for scale in scales:
+            maps.append((" x" + str(scale),) + write_synthetic(image_file, elevation_file, courses, scale, work_dir))
+        for suffix, map_image, map_elevation, path_files in maps:
+            for course, path_file in zip(courses, path_files):
+                for season in seasons:
+                    name = os.path.basename(course) + " " + season + suffix
+                    cases[name] = run_case(map_image, map_elevation, path_file, season, repeat, memory)
+                    print("%-28s %3d legs %8.1f legs/s  p50 %7.4f s  p90 %7.4f s  %9d expanded" % (
+                        name, cases[name]["legs"], cases[name]["throughput"], cases[name]["latency_p50"],
+                        cases[name]["latency_p90"], cases[name]["expanded"]))
+    results = {"machine": platform.platform(), "python": platform.python_version(), "cases": cases,
+               "total": summarize(cases)}
+    if engines is None:
+        engines = sorted(ENGINES)
+    if engines:
+        deviation, mismatches = check_engines(image_file, elevation_file, courses, seasons, engines, tolerance)
+        results["engines"] = {"deviation": deviation, "mismatches": mismatches}
+    if replan_legs > 0:
+        plans, mismatches = check_replanner(image_file, elevation_file, courses, seasons, replan_legs, tolerance)
+        results["replanner"] = {"plans": plans, "mismatches": mismatches}
+    if order_controls > 0:
+        gap, failures = check_course_order(image_file, elevation_file, courses, seasons, order_controls, tolerance)
+        results["order"] = {"heuristic_gap": gap, "failures": failures}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the route planner and checks it against a baseline")
+    parser.add_argument("image_file", nargs="?", default="terrain.png", help="terrain image")
+    parser.add_argument("elevation_file", nargs="?", default="elevations.txt", help="elevation file")
+    parser.add_argument("--courses", nargs="+", default=list(COURSES), help="path files to route")
+    parser.add_argument("--seasons", nargs="+", choices=SEASONS, default=list(SEASONS))
+    parser.add_argument("--scales", nargs="*", type=int, default=[2],
+                        help="tiling factors of the synthetic larger maps, none to skip them")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the fastest is kept")
+    parser.add_argument("--no-memory", action="store_true", help="skip the memory traced runs")
+    parser.add_argument("--engines", nargs="*", choices=sorted(ENGINES),
+                        help="engines checked against Dijkstra, all by default, none to skip the check")
+    parser.add_argument("--tolerance", type=float, default=1e-6,
+                        help="largest relative difference of travel times accepted")
+    parser.add_argument("--replan-legs", type=int, default=3,
+                        help="legs of every course replanned through closures and speed changes, 0 to skip")
+    parser.add_argument("--order-controls", type=int, default=7,
+                        help="controls of every course reordered to check the order optimizer, 0 to skip")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results stored in this JSON file")
+    parser.add_argument("--save-baseline", help="store the results as the baseline in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative worsening of a metric reported as a regression")
+    args = parser.parse_args()
+    results = run_benchmark(args.image_file, args.elevation_file, args.courses, args.seasons, args.scales,
+                            args.repeat, not args.no_memory, args.engines, args.tolerance, args.replan_legs,
+                            args.order_controls)
+    total = results["total"]
+    print("total: %d legs, %.1f legs/s, %d expanded" % (total["legs"], total["throughput"], total["expanded"])
+          + ("" if args.no_memory else ", peak %.1f MB" % (total["peak_bytes"] / 2 ** 20)))
+    failed = False
+    for name, difference in results.get("engines", {}).get("deviation", {}).items():
+        print("%-14s largest difference from Dijkstra %.3g%s" % (
+            name, difference, " (approximate)" if name in APPROXIMATE_ENGINES else ""))
+    for mismatch in results.get("engines", {}).get("mismatches", []):
+        failed = True
+        print("MISMATCH %(engine)s %(season)s %(start)s -> %(end)s: %(time).6f, Dijkstra %(reference).6f" % mismatch)
+    if "replanner" in results:
+        print("replanner      %d plans compared with A*" % results["replanner"]["plans"])
+    for mismatch in results.get("replanner", {}).get("mismatches", []):
+        failed = True
+        print("MISMATCH replan after %(change)s %(season)s %(start)s -> %(end)s: %(time).6f, A* %(reference).6f"
+              % mismatch)
+    if "order" in results:
+        print("course order   heuristic at most %.3g above Held-Karp" % results["order"]["heuristic_gap"])
+    for failure in results.get("order", {}).get("failures", []):
+        failed = True
+        print("ORDER " + failure)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for regression in compare(results, baseline, args.threshold, args.tolerance):
+            failed = True
+            print("REGRESSION " + regression)
+    for file_name in (args.output, args.save_baseline):
+        if file_name:
+            with open(file_name, "w") as f:
+                json.dump(results, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import argparse
+import json
+from math import inf
+from LegCache import LegCache
+from MapCache import MapCache
+from main import finite_json, project1, prepare_season
+from parallel import one_to_many, solve_one_to_many
+from Season import SEASONS
+
+"""
+Course planning over all pairwise leg costs. travel_time_matrix runs one multi target Dijkstra
+per control point and optimize_order finds a good visiting order of the controls from it.
+"""
+
+# Orders with at most this many free controls are solved exactly
+EXACT_LIMIT = 12
+
+
+def travel_time_matrix(grid, points, workers=None, leg_cache=None, season=None):
+    """
+    Travel time between every ordered pair of points
+    :param grid: weighted grid
+    :param points: list of (x, y)
+    :param workers: run the sources in this many processes, sequentially if not given
+    :param leg_cache: optional leg cache, the legs missing from it are filled with one Dijkstra per source
+    :param season: season of the legs in the leg cache
+    :return: matrix as a list of rows, matrix[i][j] is the time from points[i] to points[j]
+    """
+    unique = list(dict.fromkeys(points))
+    if leg_cache is not None:
+        # the leg cache lives in this process, so its sources are solved here
+        rows = []
+        for source in unique:
+            legs = leg_cache.populate(grid, season, source, unique)
+            rows.append([inf if legs[target] is None else legs[target][1] for target in unique])
+    elif workers is not None and workers > 1 and len(unique) > 1:
+        rows = one_to_many(grid, unique, unique, workers)
+    else:
+        rows = [solve_one_to_many(source, unique, grid) for source in unique]
+    position = {point: i for i, point in enumerate(unique)}
+    return [[rows[position[a]][position[b]] for b in points] for a in points]
+
+
+def route_cost(matrix, order):
+    """
+    Travel time of visiting points in order
+    :param matrix: travel time matrix
+    :param order: list of point indices
+    :return: total travel time
+    """
+    return sum(matrix[a][b] for a, b in zip(order, order[1:]))
+
+
+def held_karp(matrix, start, end, free):
+    """
+    Exact dynamic program over subsets of the free controls
+    :param matrix: travel time matrix
+    :param start: index of the first point
+    :param end: index of the last point, None for an open course
+    :param free: indices that can be visited in any order
+    :return: (order, travel time)
+    """
+    m = len(free)
+    if m == 0:
+        order = [start] + ([end] if end is not None else [])
+        return order, route_cost(matrix, order)
+    full = (1 << m) - 1
+    best = [[inf] * m for _ in range(1 << m)]
+    parent = [[-1] * m for _ in range(1 << m)]
+    for j in range(m):
+        best[1 << j][j] = matrix[start][free[j]]
+    for mask in range(1, full + 1):
+        row = best[mask]
+        for j in range(m):
+            if row[j] == inf or not (mask >> j) & 1:
+                continue
+            for k in range(m):
+                if (mask >> k) & 1:
+                    continue
+                cost = row[j] + matrix[free[j]][free[k]]
+                if cost < best[mask | (1 << k)][k]:
+                    best[mask | (1 << k)][k] = cost
+                    parent[mask | (1 << k)][k] = j
+    closing = [best[full][j] + (matrix[free[j]][end] if end is not None else 0) for j in range(m)]
+    last = min(range(m), key=lambda j: closing[j])
+    order = []
+    mask = full
+    while last != -1:
+        order.append(free[last])
+        mask, last = mask & ~(1 << last), parent[mask][last]
+    order.reverse()
+    order = [start] + order + ([end] if end is not None else [])
+    return order, route_cost(matrix, order)
+
+
+def improve(matrix, order, open_end=False):
+    """
+    Local search with 2-opt segment reversals and Or-opt moves of 1 to 3 controls, the first
+    point stays in place and so does the last unless the course is open, costs may be
+    asymmetric so every move is priced in full
+    :param matrix: travel time matrix
+    :param order: starting order
+    :param open_end: the last point can move as well, for open courses
+    :return: (order, travel time)
+    """
+    best_cost = route_cost(matrix, order)
+    improved = True
+    while improved:
+        improved = False
+        n = len(order)
+        # points at indices 1 up to movable - 1 can move
+        movable = n if open_end else n - 1
+        for i in range(1, movable):
+            for j in range(i + 1, movable):
+                candidate = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+                cost = route_cost(matrix, candidate)
+                if cost < best_cost - 1e-9:
+                    order, best_cost, improved = candidate, cost, True
+        for length in (1, 2, 3):
+            for i in range(1, movable - length + 1):
+                segment = order[i:i + length]
+                rest = order[:i] + order[i + length:]
+                for k in range(1, len(rest) + 1 if open_end else len(rest)):
+                    candidate = rest[:k] + segment + rest[k:]
+                    cost = route_cost(matrix, candidate)
+                    if cost < best_cost - 1e-9:
+                        order, best_cost, improved = candidate, cost, True
+                        break
+    return order, best_cost
+
+
+def optimize_order(matrix, start=0, end=None):
+    """
+    Visiting order of the points, starting at start and finishing at end
+    :param matrix: travel time matrix
+    :param start: index of the first point
+    :param end: index of the last point, None for an open course
+    :return: (order of point indices, travel time)
+    """
+    free = [i for i in range(len(matrix)) if i != start and i != end]
+    if len(free) <= EXACT_LIMIT:
+        return held_karp(matrix, start, end, free)
+    return heuristic_order(matrix, start, end)
+
+
+def heuristic_order(matrix, start=0, end=None):
+    """
+    Good visiting order for courses too large for held_karp, a nearest neighbour tour improved
+    by local search
+    :param matrix: travel time matrix
+    :param start: index of the first point
+    :param end: index of the last point, None for an open course
+    :return: (order of point indices, travel time)
+    """
+    free = [i for i in range(len(matrix)) if i != start and i != end]
+    # nearest neighbour tour as the starting point of the local search
+    order = [start]
+    remaining = set(free)
+    while remaining:
+        last = order[-1]
+        following = min(remaining, key=lambda k: matrix[last][k])
+        order.append(following)
+        remaining.discard(following)
+    if end is not None:
+        order.append(end)
+    return improve(matrix, order, end is None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pairwise leg times and the best order of the controls")
+    parser.add_argument("image_file", help="terrain image")
+    parser.add_argument("elevation_file", help="elevation file")
+    parser.add_argument("path_file", help="control points, the first is the start and the last the finish")
+    parser.add_argument("season", choices=SEASONS)
+    parser.add_argument("--workers", type=int, help="compute the matrix in this many processes")
+    parser.add_argument("--cache-dir", help="directory of the preprocessed map cache")
+    parser.add_argument("--leg-store", help="sqlite file of solved legs, filled with the legs between the points")
+    args = parser.parse_args()
+    drive = project1(args.image_file, args.elevation_file, args.path_file, args.season, None)
+    points = [(int(point[0]), int(point[1])) for point in drive.read_goal()]
+    drive_season = prepare_season(drive, args.season, MapCache(args.cache_dir) if args.cache_dir else None)
+    leg_cache = LegCache(store_file=args.leg_store) if args.leg_store else None
+    matrix = travel_time_matrix(drive_season.grid, points, args.workers, leg_cache, args.season)
+    if leg_cache is not None:
+        leg_cache.close()
+    # the start and the finish stay in place, the controls in between are reordered
+    order, time = optimize_order(matrix, 0, len(points) - 1)
+    print(json.dumps(finite_json({"points": points, "matrix": matrix,
+                                  "given_time": route_cost(matrix, list(range(len(points)))),
+                                  "order": [points[i] for i in order], "time": time}), allow_nan=False))
+
+
+if __name__ == "__main__":
+    main()
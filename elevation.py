@@ -0,0 +1,99 @@
+import argparse
+import os
+import numpy as np
+
+"""
+Elevation files. Besides the whitespace separated text of elevations.txt, elevations can be kept
+as .npy files or in a compact binary format: a 16 byte header (magic, version, height, width as
+little endian uint32) followed by the rows of little endian float32 values. The format is told
+by the first bytes of a file, whatever its name. Binary and .npy files are memory mapped, so only
+the pages a search touches are read from disk.
+"""
+
+ELEVATION_MAGIC = b"ELEV"
+ELEVATION_VERSION = 1
+HEADER_DTYPE = np.dtype([("magic", "S4"), ("version", "<u4"), ("height", "<u4"), ("width", "<u4")])
+NPY_MAGIC = b"\x93NUMPY"
+
+
+def read_text(file_name):
+    """
+    Parses a text elevation file, one row of the map per line
+    :param file_name: text file
+    :return: float32 array, indexed [y, x]
+    """
+    with open(file_name) as f:
+        text = f.read()
+    values = np.fromstring(text, dtype=np.float32, sep=" ")
+    rows = sum(1 for line in text.splitlines() if line.strip())
+    if rows == 0 or values.size % rows:
+        raise ValueError("rows of different lengths in " + file_name)
+    return values.reshape(rows, -1)
+
+
+def read_binary(file_name):
+    """
+    Memory maps a binary elevation file
+    :param file_name: binary file
+    :return: read only float32 array, indexed [y, x]
+    """
+    header = np.fromfile(file_name, dtype=HEADER_DTYPE, count=1)
+    if header.size == 0 or header["magic"][0] != ELEVATION_MAGIC:
+        raise ValueError("not a binary elevation file: " + file_name)
+    if header["version"][0] != ELEVATION_VERSION:
+        raise ValueError("unsupported elevation file version " + str(header["version"][0]))
+    shape = (int(header["height"][0]), int(header["width"][0]))
+    return np.memmap(file_name, dtype="<f4", mode="r", offset=HEADER_DTYPE.itemsize, shape=shape)
+
+
+def load_elevation(file_name):
+    """
+    Reads an elevation file in the format given by its first bytes, binary and .npy files are
+    memory mapped and anything else is parsed as text
+    :param file_name: elevation file
+    :return: float32 array, indexed [y, x]
+    """
+    with open(file_name, "rb") as f:
+        magic = f.read(len(NPY_MAGIC))
+    if magic.startswith(ELEVATION_MAGIC):
+        return read_binary(file_name)
+    if magic == NPY_MAGIC:
+        elevation = np.load(file_name, mmap_mode="r")
+        if elevation.ndim != 2:
+            raise ValueError("elevations must be a 2D array: " + file_name)
+        return elevation if elevation.dtype == np.float32 else elevation.astype(np.float32)
+    return read_text(file_name)
+
+
+def write_elevation(elevation, file_name):
+    """
+    Writes elevations as a binary file, or as .npy when file_name ends in .npy, load_elevation
+    reads either back whatever the name. The file only appears once it is complete
+    :param elevation: 2D array of elevations
+    :param file_name: output file
+    :return: None
+    """
+    elevation = np.ascontiguousarray(elevation, dtype="<f4")
+    temp_file = file_name + ".%d.tmp" % os.getpid()
+    with open(temp_file, "wb") as f:
+        if file_name.lower().endswith(".npy"):
+            np.save(f, elevation)
+        else:
+            header = np.array([(ELEVATION_MAGIC, ELEVATION_VERSION) + elevation.shape], dtype=HEADER_DTYPE)
+            header.tofile(f)
+            elevation.tofile(f)
+    os.replace(temp_file, file_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts elevation files between text, .npy and binary")
+    parser.add_argument("source", help="elevation file to read")
+    parser.add_argument("target", help="file to write, .npy for numpy, binary otherwise (e.g. .elev)")
+    args = parser.parse_args()
+    elevation = load_elevation(args.source)
+    write_elevation(elevation, args.target)
+    print("wrote " + args.target + " (" + str(elevation.shape[0]) + " x " + str(elevation.shape[1]) + ")")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,17 @@
-from PIL import Image, ImageDraw
-from Season import Season
+from PIL import Image
+import numpy as np
+from Season import Season, SEASONS
+from MapCache import MapCache
+from ClusterGraph import ClusterGraph
+from Landmarks import Landmarks
+from parallel import solve_legs
+from elevation import load_elevation
+from render import Renderer
+from Profiler import Profiler, stage
+from terrain import TERRAIN_COLORS, OUT_OF_BOUNDS, PIXEL_WIDTH, PIXEL_HEIGHT, color_class, classify
 from math import *
-import sys
+import argparse
+import hashlib
 
 
 
@@ -14,21 +24,29 @@ with a general public usage license
 
 class Grid:
     # grid is completed, need to think bout the cost and pixel
-    def __init__(self, width, height, pixel_data, elevation_data, goal_points):
+    def __init__(self, width, height, terrain, elevation, goal_points):
         """
         Initialization of Parameter
         :param width: width of image
         :param height: height of image
-        :param pixel_data: pixel data
-        :param elevation_data: elevation data
+        :param terrain: uint8 terrain class array, indexed [y, x]
+        :param elevation: float32 elevation array, indexed [y, x]
         :param goal_points: points to travel
         """
         self.width = width
         self.height = height
-        self.pix_copy = pixel_data
-        self.ele_copy = elevation_data
+        self.terrain = terrain
+        self.elevation = elevation
         self.goal_points = goal_points
         self.speed_values = {}
+        self.speed_table = None
+        self.speed = None
+        self.max_speed = None
+        self.cost_fingerprint = None
+        self.cluster_graph = None
+        self.landmarks = None
+        self.flow_fields = None
+        self.flat = None
 
     def speed_set(self):
         """
@@ -55,6 +73,55 @@ class Grid:
         self.speed_values[(255, 192, 0)] = 4
         # open land
         self.speed_values[(248, 148, 18)] = 8
+        self.update_speed_table()
+
+    def update_speed_table(self):
+        """
+        Rebuilds the speed lookup table indexed by terrain class from speed_values and
+        the per pixel speed raster, classes without a speed move at the out of bounds speed
+        :return: speed lookup table
+        """
+        default = self.speed_values.get(TERRAIN_COLORS[OUT_OF_BOUNDS], 0.01)
+        self.speed_table = np.full(len(TERRAIN_COLORS), default, dtype=np.float32)
+        for color, speed in self.speed_values.items():
+            if color in TERRAIN_COLORS:
+                self.speed_table[color_class(color)] = speed
+        self.max_speed = self.speed_table.max().item()
+        self.speed = self.speed_raster()
+        self.cost_fingerprint = None
+        return self.speed_table
+
+    def speed_raster(self):
+        """
+        Speed of every pixel from the speed lookup table
+        :return: float32 speed array, indexed [y, x]
+        """
+        return self.speed_table[self.terrain]
+
+    def fingerprint(self):
+        """
+        Content hash of everything the travel times depend on, computed once per speed table
+        :return: hex digest
+        """
+        if self.cost_fingerprint is None:
+            digest = hashlib.sha256()
+            for array in (self.terrain, self.elevation, self.speed):
+                digest.update(str(array.shape).encode())
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self.cost_fingerprint = digest.hexdigest()[:32]
+        return self.cost_fingerprint
+
+    def with_terrain(self, terrain):
+        """
+        Creates a grid over other terrain classes sharing the elevation of this grid
+        :param terrain: terrain class array
+        :return: weighted grid with copied speeds
+        """
+        grid = type(self)(self.width, self.height, terrain, self.elevation, self.goal_points)
+        grid.speed_values = dict(self.speed_values)
+        if self.speed_table is not None:
+            grid.update_speed_table()
+        return grid
 
     def in_bounds(self, id):
         """
@@ -63,8 +130,7 @@ class Grid:
         :return: True if in bound , else false
         """
         (x, y) = id
-        # add condition that pixels[x,y]!=(205,0,101)
-        return 0 <= x < self.width and 0 <= y < self.height and self.pix_copy[x, y] != (205, 0, 101)
+        return 0 <= x < self.width and 0 <= y < self.height and self.terrain.item(y, x) != OUT_OF_BOUNDS
 
     def neighbors(self, x1, y1):
         """
@@ -86,55 +152,47 @@ class Grid:
 
 class GridWithWeights(Grid):
 
-    def __init__(self, width, height, pixel_data, elevation_data, goal_points):
+    def __init__(self, width, height, terrain, elevation, goal_points):
         """
         Initialization of a weighted grid
         :param width: width of image
         :param height: height of image
-        :param pixel_data: pixel data
-        :param elevation_data: elevation data
+        :param terrain: terrain class array
+        :param elevation: elevation array
         :param goal_points: points to visit
         """
-        super().__init__(width, height, pixel_data, elevation_data, goal_points)
+        super().__init__(width, height, terrain, elevation, goal_points)
         self.weights = {}
 
-    def cost_g(self, x1_p, y1_p, x2_n, y2_n):
+    def cost(self, x1_p, y1_p, x2_n, y2_n):
         """
-        Cost of moving from one node to its immediate neighbor
+        Travel time of moving from one node to its immediate neighbor,
+        distance in 3D space over the speed of the terrain being left
         :param x1_p: previous x
         :param y1_p: previous y
         :param x2_n: neighbor x
         :param y2_n: neighbor y
-        :return:
+        :return: time to travel
         """
-        return 1
+        dx = (x2_n - x1_p) * PIXEL_WIDTH
+        dy = (y2_n - y1_p) * PIXEL_HEIGHT
+        dz = self.elevation.item(y2_n, x2_n) - self.elevation.item(y1_p, x1_p)
+        return sqrt(dx * dx + dy * dy + dz * dz) / self.speed.item(y1_p, x1_p)
 
     def heuristic(self, x1_p, y1_p, x2_n, y2_n):
         """
-        Heuristic function, distance between two nodes in 3D space
+        Heuristic function, straight line distance between two nodes in 3D space
+        travelled at the maximum speed, never overestimates the travel time
         :param x1_p: node x
         :param y1_p: node y
-        :param x2_n: next x
-        :param y2_n: next y
-        :return:
+        :param x2_n: goal x
+        :param y2_n: goal y
+        :return: lower bound on the travel time
         """
-        x1 = int(x1_p)
-        y1 = int(y1_p)
-        z1 = float(self.ele_copy[x1][y1_p])
-        x2 = int(x2_n)
-        y2 = int(y2_n)
-        z2 = float(self.ele_copy[x2_n][y2_n])
-        if (x2 == (x1 + 1) or x2 == (x1 - 1)) and y2 == y1:
-            cost = 10.29
-        elif (y2 == (y1 + 1) or y2 == (y1 - 1)) and y2 == y1:
-            cost = 7.55
-        else:
-            cost = sqrt(((x2 - x1) * 10.29) ** 2 + ((y2 - y1) * 7.55) ** 2)
-            cost = sqrt(cost ** 2 + (z2 - z1) ** 2)
-        # change speed
-        speed = self.speed_values[self.pix_copy[x1_p, y1_p]]
-        time = cost / speed
-        return time
+        dx = (x2_n - x1_p) * PIXEL_WIDTH
+        dy = (y2_n - y1_p) * PIXEL_HEIGHT
+        dz = self.elevation.item(y2_n, x2_n) - self.elevation.item(y1_p, x1_p)
+        return sqrt(dx * dx + dy * dy + dz * dz) / self.max_speed
 
 
 class project1:
@@ -154,8 +212,8 @@ class project1:
         self.goal_points = []
         self.width = None
         self.height = None
-        self.pixel_data = None
-        self.elevation_data = []
+        self.terrain_data = None
+        self.elevation_data = None
         self.output_image = output_image
         self.season = season
 
@@ -172,61 +230,76 @@ class project1:
 
     def read_image(self):
         """
-        Reads image
-        :return: pixel data array
+        Reads image and converts it to terrain classes
+        :return: terrain class array
         """
         open_image = Image.open(self.map_image)
         open_image = open_image.convert('RGB')
         self.width, self.height = open_image.size
-        self.pixel_data = open_image.load()
+        self.terrain_data = classify(np.asarray(open_image))
+        return self.terrain_data
 
     def read_elevation(self):
         """
-        Reads and changes dimension of elevation data array
-        :return: elevation data array
+        Reads elevation data in the text, .npy or binary format, see elevation.load_elevation,
+        the last 5 columns lie outside the map
+        :return: float32 elevation array, indexed [y, x]
         """
-        with open(self.elevation_file) as f:
-            for i in f:
-                self.elevation_data.append(i.split())
-        self.elevation_data = [[self.elevation_data[i][j] for i in range(len(self.elevation_data))] for j in
-                               range(len(self.elevation_data[0]) - 5)]
+        self.elevation_data = load_elevation(self.elevation_file)[:, :-5]
         return self.elevation_data
 
+    def use_arrays(self, terrain, elevation):
+        """
+        Uses terrain classes and elevation that were read earlier, e.g. from the map cache
+        :param terrain: terrain class array
+        :param elevation: elevation array
+        :return: None
+        """
+        self.height, self.width = terrain.shape
+        self.terrain_data = terrain
+        self.elevation_data = elevation
+
     def create_grid(self):
         """
         Creates a weighted Grid and sets the speeds at pixels
         :return: weighted Grid
         """
         self.grid = GridWithWeights(self.width, self.height,
-                                    self.pixel_data, self.elevation_data, self.goal_points)
+                                    self.terrain_data, self.elevation_data, self.goal_points)
         self.grid.speed_set()
 
-    def create_image(self, map_image,output_image, final_path, color):
-        """
-        Creates output images from the updated season map
-        :param map_image: original image
-        :param output_image: output image
-        :param final_path: the final path
-        :param color: color with which we draw on the map
-        :return: output image
-        """
-        im = Image.open(map_image)
-        draw = ImageDraw.Draw(im)
-        draw.line(final_path, fill=color, width=1)
-        im.show()
-        im.save(output_image)
-
 
 def main():
-    image_file = sys.argv[1]
-    elevation_file = sys.argv[2]
-    path_file = sys.argv[3]
-    season = sys.argv[4]
-    output_file = sys.argv[5]
-    driver_project(image_file,elevation_file,path_file,season,output_file)
+    parser = argparse.ArgumentParser(description="Orienteering route planner")
+    parser.add_argument("image_file", help="terrain image")
+    parser.add_argument("elevation_file", help="elevation file")
+    parser.add_argument("path_file", help="control points to visit in order")
+    parser.add_argument("season", choices=SEASONS)
+    parser.add_argument("output_file", help="output image")
+    parser.add_argument("--cache-dir", help="directory of the preprocessed map cache")
+    parser.add_argument("--workers", type=int, help="solve the legs in this many processes")
+    parser.add_argument("--no-render", action="store_true", help="only compute the route, write no image")
+    parser.add_argument("--thumbnail", type=int, help="also write a thumbnail with this longest side")
+    parser.add_argument("--color-legs", action="store_true", help="draw every leg in its own colour")
+    parser.add_argument("--profile", help="write stage timings and per leg search counters to this JSON lines file")
+    parser.add_argument("--memory", action="store_true", help="also trace the peak memory of every stage and leg")
+    parser.add_argument("--heatmap", help="write an image of the expanded cells to this file")
+    args = parser.parse_args()
+    profiler = None
+    if args.profile or args.memory or args.heatmap:
+        profiler = Profiler(args.profile, args.memory, args.heatmap is not None)
+    drive_season = driver_project(args.image_file, args.elevation_file, args.path_file, args.season,
+                                  args.output_file, cache_dir=args.cache_dir, workers=args.workers,
+                                  renderer=Renderer(not args.no_render, args.thumbnail, args.color_legs),
+                                  profiler=profiler)
+    if profiler is not None:
+        if args.heatmap:
+            profiler.save_heatmap(args.heatmap, drive_season.grid.terrain)
+        profiler.close()
 
 
-def driver_project(image_file,elevation_file,path_file,season,output_file):
+def driver_project(image_file,elevation_file,path_file,season,output_file,cache_dir=None,workers=None,
+                   renderer=None,profiler=None):
     """
     Driver function of the project
     :param image_file: image file
@@ -234,55 +307,130 @@ def driver_project(image_file,elevation_file,path_file,season,output_file):
     :param path_file: path file
     :param season: season
     :param output_file: outputfile
-    :return: None
+    :param cache_dir: optional directory of the preprocessed map cache
+    :param workers: solve the legs in this many processes
+    :param renderer: optional Renderer, the route is drawn in red on the output file by default
+    :param profiler: optional Profiler recording the stages and legs
+    :return: season object
     """
     drive = project1(image_file,elevation_file,path_file,season,output_file)
     drive.read_goal()
-    drive.read_image()
-    drive.read_elevation()
-    drive.create_grid()
-    drive_season = Season(drive.grid,image_file,output_file,season)
-    driver_season(drive_season,drive,image_file,output_file)
+    cache = MapCache(cache_dir) if cache_dir else None
+    drive_season = prepare_season(drive, season, cache, profiler=profiler)
+    driver_season(drive_season,drive,image_file,output_file,workers,renderer,profiler)
+    return drive_season
+
+
+def finite_json(value):
+    """
+    Replaces infinite and nan floats, such as the time of an unreachable leg, with None so the
+    value is written as strict JSON, which has no Infinity
+    :param value: JSON serializable value
+    :return: value with null in place of non finite floats
+    """
+    if isinstance(value, float):
+        return value if isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: finite_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [finite_json(item) for item in value]
+    return value
 
 
-def driver_season(drive_season,drive,image_file,output_file):
+def prepare_season(drive, season, cache=None, hierarchy=False, landmarks=False, profiler=None):
+    """
+    Builds the seasonal map, reading the terrain and elevation only if drive has no grid yet
+    :param drive: project object
+    :param season: season
+    :param cache: optional MapCache
+    :param hierarchy: also build the cluster graph used by the hpa engine, kept in the cache
+    :param landmarks: also build the landmark tables used by the alt engine, kept in the cache
+    :param profiler: optional Profiler timing the stages
+    :return: season object
+    """
+    with stage(profiler, "cache load", season=season):
+        cached = cache.load(drive.map_image, drive.elevation_file, season) if cache is not None else None
+    if cached is None:
+        if drive.grid is None:
+            with stage(profiler, "image load"):
+                drive.read_image()
+            with stage(profiler, "elevation parse"):
+                drive.read_elevation()
+            drive.create_grid()
+        with stage(profiler, "season transform", season=season):
+            drive_season = Season(drive.grid,drive.map_image,drive.output_image,season)
+            drive_season.apply_season()
+        if cache is not None:
+            with stage(profiler, "cache store", season=season):
+                cache.store(drive.map_image, drive.elevation_file, season,
+                            {"terrain": drive.grid.terrain, "elevation": drive.grid.elevation,
+                             "season_terrain": drive_season.grid.terrain, "speed": drive_season.grid.speed})
+    else:
+        if drive.grid is None:
+            drive.use_arrays(cached["terrain"], cached["elevation"])
+            drive.create_grid()
+        with stage(profiler, "season transform", season=season, cached=True):
+            drive_season = Season(drive.grid,drive.map_image,drive.output_image,season)
+            drive_season.apply_season(cached["season_terrain"], cached["speed"])
+    for wanted, name, structure in ((hierarchy, "cluster_graph", ClusterGraph), (landmarks, "landmarks", Landmarks)):
+        if not wanted:
+            continue
+        structure_file = None
+        if cache is not None:
+            structure_file = cache.entry_file(drive.map_image, drive.elevation_file, season, name + ".npz")
+        with stage(profiler, name, season=season):
+            if structure_file is not None:
+                setattr(drive_season.grid, name, structure.cached(drive_season.grid, structure_file))
+            else:
+                setattr(drive_season.grid, name, structure(drive_season.grid))
+    return drive_season
+
+
+def driver_season(drive_season,drive,image_file,output_file,workers=None,renderer=None,profiler=None):
     """
     Driver function for the season class
     :param drive_season: season object
     :param drive: project object
     :param image_file: image file
     :param output_file: output file
+    :param workers: solve the legs in this many processes, sequentially if not given
+    :param renderer: optional Renderer, the route is drawn in red on the output file by default
+    :param profiler: optional Profiler recording the search of every leg and the rendering
     :return:
     """
     created_path = []
-    if drive_season.season == "summer":
-        print("Entering Astar")
-        for i in range(len(drive.goal_points)-1):
-            start_point = drive.goal_points[i]
-            current_end_point = drive.goal_points[i+1]
-            start_point_txt = (int(start_point[0]),int(start_point[1]))
-            end_point_txt = (int(current_end_point[0]), int(current_end_point[1]))
-            created_path = created_path + drive_season.a_star(start_point_txt,end_point_txt)
-        drive.create_image(image_file, output_file,created_path, (255, 0, 0))
-        drive_season.total_cost_2D(created_path)
-    else:
-        boundaries = drive_season.season_limits()
-        drive_season.bfs_season(boundaries)
-        for i in range(len(drive.goal_points)-1):
-            start_point = drive.goal_points[i]
-            current_end_point = drive.goal_points[i+1]
-            start_point_txt = (int(start_point[0]),int(start_point[1]))
-            end_point_txt = (int(current_end_point[0]), int(current_end_point[1]))
-            created_path = created_path + drive_season.a_star(start_point_txt,end_point_txt)
-        if drive_season.season=="winter":
-            drive.create_image("temp_winter.png", output_file, created_path, (255, 0, 0))
-            drive_season.total_cost_2D(created_path)
-        elif drive_season.season=="spring":
-            drive.create_image("temp_spring.png", output_file, created_path, (255, 0, 0))
-            drive_season.total_cost_2D(created_path)
+    leg_paths = []
+    legs = []
+    for i in range(len(drive.goal_points)-1):
+        start_point = drive.goal_points[i]
+        current_end_point = drive.goal_points[i+1]
+        start_point_txt = (int(start_point[0]),int(start_point[1]))
+        end_point_txt = (int(current_end_point[0]), int(current_end_point[1]))
+        legs.append((start_point_txt, end_point_txt))
+    grid = drive_season.grid
+    with stage(profiler, "search", season=drive_season.season, legs=len(legs)):
+        if workers is not None and workers > 1:
+            results = solve_legs(grid, legs, workers, trace=profiler is not None and profiler.heatmap)
+            for leg, (path, time, stats) in zip(legs, results):
+                leg_paths.append(path)
+                if profiler is not None:
+                    stats["time"] = time
+                    profiler.record_leg(grid, leg[0], leg[1], stats, season=drive_season.season)
         else:
-            drive.create_image("temp_fall.png", output_file, created_path, (255, 0, 0))
-            drive_season.total_cost_2D(created_path)
+            for start_point_txt, end_point_txt in legs:
+                if profiler is None:
+                    leg_paths.append(drive_season.a_star(start_point_txt,end_point_txt))
+                    continue
+                with profiler.leg(grid, start_point_txt, end_point_txt, season=drive_season.season) as stats:
+                    leg_paths.append(drive_season.a_star(start_point_txt,end_point_txt,stats))
+    for path in leg_paths:
+        created_path = created_path + path
+    if renderer is None:
+        renderer = Renderer()
+    with stage(profiler, "rendering"):
+        renderer.add(output_file, grid.terrain, leg_paths, (255, 0, 0))
+        renderer.render()
+    drive_season.total_cost_2D(created_path)
     return created_path
 
 
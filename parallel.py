@@ -0,0 +1,156 @@
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter
+import numpy as np
+import search
+
+"""
+Solves independent legs in a process pool. The read only rasters of the grid are placed
+in shared memory once, workers attach to them instead of receiving a pickled copy of the map.
+"""
+
+SHARED_ARRAYS = ("terrain", "elevation", "speed")
+
+# grid of the current worker process, built by init_worker
+worker_grid = None
+worker_blocks = []
+
+
+class SharedGrid:
+    def __init__(self, grid):
+        """
+        Copies the rasters of a grid into shared memory blocks
+        :param grid: weighted grid
+        """
+        self.blocks = []
+        self.spec = {"width": grid.width, "height": grid.height, "fingerprint": grid.fingerprint(),
+                     "speed_table": np.array(grid.speed_table), "cluster_graph": grid.cluster_graph,
+                     "arrays": {}}
+        arrays = {name: getattr(grid, name) for name in SHARED_ARRAYS}
+        if grid.landmarks is not None:
+            arrays["landmark_table"] = grid.landmarks.table
+            self.spec["landmark_nodes"] = grid.landmarks.nodes
+        try:
+            for name, array in arrays.items():
+                array = np.asarray(array)
+                block = SharedMemory(create=True, size=max(array.nbytes, 1))
+                self.blocks.append(block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                self.spec["arrays"][name] = (block.name, array.shape, array.dtype.str)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Releases the shared memory blocks
+        :return: None
+        """
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach_grid(spec):
+    """
+    Builds a grid over the shared memory blocks described by spec
+    :param spec: SharedGrid.spec
+    :return: (weighted grid, attached blocks)
+    """
+    from main import GridWithWeights
+    from Landmarks import Landmarks
+    blocks = []
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec["arrays"].items():
+        block = SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    grid = GridWithWeights(spec["width"], spec["height"], arrays["terrain"], arrays["elevation"], None)
+    grid.speed_table = spec["speed_table"]
+    grid.max_speed = grid.speed_table.max().item()
+    grid.speed = arrays["speed"]
+    # hashing the rasters again in every worker would give the same digest
+    grid.cost_fingerprint = spec["fingerprint"]
+    grid.cluster_graph = spec["cluster_graph"]
+    if "landmark_table" in arrays:
+        grid.landmarks = Landmarks(grid, build=False)
+        grid.landmarks.nodes = spec["landmark_nodes"]
+        grid.landmarks.table = arrays["landmark_table"]
+    return grid, blocks
+
+
+def init_worker(spec):
+    """
+    Pool initializer, attaches the worker to the shared grid
+    :param spec: SharedGrid.spec
+    :return: None
+    """
+    global worker_grid, worker_blocks
+    worker_grid, worker_blocks = attach_grid(spec)
+
+
+def solve_leg(leg, grid=None, method="astar", options=None, trace=False):
+    """
+    Solves one leg, on the grid of the worker unless a grid is given
+    :param leg: (start, final)
+    :param grid: optional weighted grid
+    :param method: name of the engine in search.ENGINES
+    :param options: optional keyword arguments of the engine
+    :param trace: also return the expanded cells in the counters, for heatmaps
+    :return: (path, time, search counters including the wall time in seconds)
+    """
+    stats = {"cells": []} if trace else {}
+    began = perf_counter()
+    engine = search.ENGINES[method]
+    path, time = engine(grid if grid is not None else worker_grid, leg[0], leg[1], stats, **(options or {}))
+    stats["seconds"] = perf_counter() - began
+    return path, time, stats
+
+
+def solve_one_to_many(source, targets, grid=None):
+    """
+    Travel times from one source to many targets with a single Dijkstra
+    :param source: starting node
+    :param targets: nodes to reach
+    :param grid: optional weighted grid, the grid of the worker otherwise
+    :return: list of travel times in the order of the targets
+    """
+    results = search.dijkstra(grid if grid is not None else worker_grid, source, targets)
+    return [results[target][1] for target in targets]
+
+
+def one_to_many(grid, sources, targets, workers=None):
+    """
+    Runs one multi target Dijkstra per source in parallel
+    :param grid: weighted grid
+    :param sources: starting nodes
+    :param targets: nodes to reach from every source
+    :param workers: number of processes, defaults to the number of cores
+    :return: list per source of travel times in the order of the targets
+    """
+    with SharedGrid(grid) as shared:
+        with Pool(workers, initializer=init_worker, initargs=(shared.spec,)) as pool:
+            return pool.starmap(solve_one_to_many, [(source, targets) for source in sources], chunksize=1)
+
+
+def solve_legs(grid, legs, workers=None, method="astar", options=None, trace=False):
+    """
+    Solves legs in parallel, results come back in the order of the legs
+    :param grid: weighted grid
+    :param legs: list of (start, final)
+    :param workers: number of processes, defaults to the number of cores
+    :param method: name of the engine in search.ENGINES
+    :param options: optional keyword arguments of the engine
+    :param trace: also return the expanded cells in the counters, for heatmaps
+    :return: list of (path, time, search counters)
+    """
+    with SharedGrid(grid) as shared:
+        with Pool(workers, initializer=init_worker, initargs=(shared.spec,)) as pool:
+            return pool.starmap(solve_leg, [(leg, None, method, options, trace) for leg in legs], chunksize=1)
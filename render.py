@@ -0,0 +1,135 @@
+import os
+from collections import OrderedDict
+import numpy as np
+from PIL import Image, ImageDraw
+from terrain import to_rgb
+
+"""
+Headless route rendering. The RGB image of a seasonal map is built once from its terrain
+classes in memory and copied for every output, routes are drawn on the copies and nothing is
+ever shown in a viewer.
+"""
+
+ROUTE_COLOR = (255, 0, 0)
+# Colours cycled over the legs of a route when legs are colour coded
+LEG_COLORS = ((255, 0, 0), (0, 0, 255), (255, 0, 255), (0, 150, 0),
+              (255, 128, 0), (0, 190, 190), (120, 0, 160), (110, 70, 0))
+
+
+def base_image(terrain):
+    """
+    Image of a map without routes
+    :param terrain: terrain class array, indexed [y, x]
+    :return: RGB image
+    """
+    return Image.fromarray(to_rgb(terrain))
+
+
+def draw_legs(image, legs, color=ROUTE_COLOR, color_legs=False):
+    """
+    Draws the legs of a route onto an image
+    :param image: RGB image, drawn on in place
+    :param legs: list of leg paths, each a list of (x, y)
+    :param color: colour of the route
+    :param color_legs: give every leg its own colour from LEG_COLORS instead
+    :return: the image
+    """
+    draw = ImageDraw.Draw(image)
+    for k, leg in enumerate(legs):
+        fill = LEG_COLORS[k % len(LEG_COLORS)] if color_legs else color
+        if len(leg) > 1:
+            draw.line(leg, fill=fill, width=1)
+        elif leg:
+            draw.point(leg, fill=fill)
+    return image
+
+
+def heatmap_image(counts, terrain=None):
+    """
+    Image of how often every cell was expanded, on a log scale from the faint map to red
+    :param counts: array of expansion counts, indexed [y, x]
+    :param terrain: optional terrain class array drawn faintly underneath
+    :return: RGB image
+    """
+    if terrain is not None:
+        background = 160 + to_rgb(terrain).mean(axis=2, keepdims=True) * 0.35
+    else:
+        background = np.full(counts.shape + (1,), 245.0)
+    heat = np.log1p(counts.astype(np.float64))
+    if heat.max() > 0:
+        heat /= heat.max()
+    heat = heat[:, :, None]
+    red = np.array([255.0, 0.0, 0.0])
+    rgb = np.where(heat > 0, background * (1 - heat) * 0.6 + red * (0.4 + 0.6 * heat), background)
+    return Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8), "RGB")
+
+
+def thumbnail(image, size):
+    """
+    Downscaled copy of an image
+    :param image: image
+    :param size: longest side of the thumbnail in pixels
+    :return: image no larger than size x size
+    """
+    small = image.copy()
+    small.thumbnail((size, size), Image.Resampling.BOX)
+    return small
+
+
+def thumbnail_file(file_name):
+    """
+    File name of the thumbnail of an output image
+    :param file_name: output image file
+    :return: file name with _thumb before the extension
+    """
+    root, extension = os.path.splitext(file_name)
+    return root + "_thumb" + (extension or ".png")
+
+
+class Renderer:
+    def __init__(self, enabled=True, thumbnail_size=None, color_legs=False):
+        """
+        Collects routes and renders them together, every map is converted to RGB once
+        however many outputs use it and routes added to the same output share one image
+        :param enabled: False turns rendering off, for compute only runs
+        :param thumbnail_size: also write a thumbnail of this size next to every output
+        :param color_legs: give every leg its own colour
+        """
+        self.enabled = enabled
+        self.thumbnail_size = thumbnail_size
+        self.color_legs = color_legs
+        self.outputs = OrderedDict()
+
+    def add(self, output_file, terrain, legs, color=ROUTE_COLOR):
+        """
+        Queues a route, routes of an output are drawn over the map of the first one
+        :param output_file: output image file, None to skip
+        :param terrain: terrain class array of the seasonal map
+        :param legs: list of leg paths
+        :param color: colour of the route
+        :return: None
+        """
+        if not self.enabled or output_file is None:
+            return
+        self.outputs.setdefault(output_file, (terrain, []))[1].append((legs, color))
+
+    def render(self):
+        """
+        Draws and writes every queued output
+        :return: list of written files, thumbnails included
+        """
+        bases = {}
+        written = []
+        for output_file, (terrain, routes) in self.outputs.items():
+            if id(terrain) not in bases:
+                bases[id(terrain)] = (terrain, base_image(terrain))
+            image = bases[id(terrain)][1].copy()
+            for legs, color in routes:
+                draw_legs(image, legs, color, self.color_legs)
+            image.save(output_file)
+            written.append(output_file)
+            if self.thumbnail_size:
+                thumbnail(image, self.thumbnail_size).save(thumbnail_file(output_file))
+                written.append(thumbnail_file(output_file))
+        self.outputs.clear()
+        return written
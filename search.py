@@ -0,0 +1,522 @@
+from heapq import heappush, heappop, heapify
+from itertools import count
+from math import inf, sqrt
+from time import perf_counter
+import numpy as np
+from terrain import OUT_OF_BOUNDS, PIXEL_WIDTH, PIXEL_HEIGHT
+
+"""
+Search engines over a weighted grid. Grids provide neighbors(x, y), the travel time
+cost(x1, y1, x2, y2) of a single step and an admissible heuristic(x1, y1, x2, y2).
+Engines fill an optional stats dictionary with their counters, when it holds a "cells" list
+the expanded nodes are appended to it as well, e.g. for a heatmap.
+"""
+
+
+# Grid steps in the order of Grid.neighbors, OPPOSITE[k] undoes STEPS[k]
+STEPS = ((0, 1), (1, 0), (-1, 0), (0, -1))
+OPPOSITE = (3, 2, 1, 0)
+NO_STEP = 255
+
+# Anytime search: weight of the first pass, how much it drops per pass and
+# how many expansions run between two looks at the clock
+ANYTIME_INFLATION = 3.0
+ANYTIME_STEP = 0.5
+ANYTIME_CHECK = 256
+
+
+def build_path(parents, final):
+    """
+    Walks the parent links back from the final node
+    :param parents: dictionary of node to parent node, the start maps to None
+    :param final: last node of the path
+    :return: list of nodes from start to final
+    """
+    path = []
+    curr = final
+    while curr is not None:
+        path.append(curr)
+        curr = parents[curr]
+    path.reverse()
+    return path
+
+
+def path_time(grid, path):
+    """
+    Travel time of a path, for engines whose own sums differ from a plain search, summed step
+    by step in float64 so it matches the time the other engines return for the same path
+    :param grid: weighted grid
+    :param path: list of nodes
+    :return: travel time
+    """
+    time = 0.0
+    for (x1, y1), (x2, y2) in zip(path, path[1:]):
+        time += grid.cost(x1, y1, x2, y2)
+    return time
+
+
+def a_star(grid, start, final, stats=None, allowed=None, heuristic=None, reopen=False):
+    """
+    A* with a binary heap and a closed set. Entries are (f, tiebreak, node), an improved
+    node is pushed again and the outdated entry is skipped when it is popped (lazy deletion)
+    :param grid: weighted grid
+    :param start: starting node
+    :param final: ending node
+    :param stats: optional dictionary that receives search counters
+    :param allowed: optional predicate restricting the search to part of the grid
+    :param heuristic: optional consistent estimate (x, y) -> travel time to final,
+                      defaults to the straight line bound of the grid
+    :param reopen: let closed nodes be improved again, keeps the result optimal when the
+                   heuristic is admissible but only nearly consistent
+    :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+    """
+    xf, yf = final
+    if heuristic is None:
+        def heuristic(x, y):
+            return grid.heuristic(x, y, xf, yf)
+    tiebreak = count()
+    frontier = [(heuristic(start[0], start[1]), next(tiebreak), start)]
+    cost_so_far = {start: 0.0}
+    parents = {start: None}
+    closed = set()
+    pushed = 1
+    stale = 0
+    peak_frontier = 1
+    found = False
+    while frontier:
+        f, _, actual_node = heappop(frontier)
+        if actual_node in closed:
+            stale += 1
+            continue
+        if actual_node == final:
+            found = True
+            break
+        closed.add(actual_node)
+        x, y = actual_node
+        g_value = cost_so_far[actual_node]
+        for neighbor in grid.neighbors(x, y):
+            if (neighbor in closed and not reopen) or (allowed is not None and not allowed(neighbor)):
+                continue
+            new_g = g_value + grid.cost(x, y, neighbor[0], neighbor[1])
+            if new_g < cost_so_far.get(neighbor, inf):
+                cost_so_far[neighbor] = new_g
+                parents[neighbor] = actual_node
+                closed.discard(neighbor)
+                heappush(frontier, (new_g + heuristic(neighbor[0], neighbor[1]), next(tiebreak), neighbor))
+                pushed += 1
+        if len(frontier) > peak_frontier:
+            peak_frontier = len(frontier)
+    if stats is not None:
+        stats["expanded"] = len(closed)
+        stats["pushed"] = pushed
+        stats["stale"] = stale
+        stats["peak_frontier"] = peak_frontier
+        if "cells" in stats:
+            stats["cells"].extend(closed)
+    if not found:
+        return [], inf
+    return build_path(parents, final), cost_so_far[final]
+
+
+def flat_a_star(grid, start, final, stats=None):
+    """
+    search.a_star on the flat arrays of a borrowed workspace, see SearchWorkspace
+    :param grid: weighted grid
+    :param start: starting node
+    :param final: ending node
+    :param stats: optional dictionary that receives search counters
+    :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+    """
+    from SearchWorkspace import borrowed
+    if not isinstance(grid.terrain, np.ndarray):
+        # maps without dense arrays, such as tiled maps, are searched through the grid interface
+        return a_star(grid, start, final, stats)
+    with borrowed() as workspace:
+        return workspace.a_star(grid, start, final, stats)
+
+
+def dijkstra(grid, start, targets, stats=None):
+    """
+    One to many Dijkstra, stops once every reachable target is settled
+    :param grid: weighted grid
+    :param start: starting node
+    :param targets: nodes to reach
+    :param stats: optional dictionary that receives search counters
+    :return: dictionary of target to (path, travel time), ([], inf) for unreachable targets
+    """
+    remaining = set(targets)
+    tiebreak = count()
+    frontier = [(0.0, next(tiebreak), start)]
+    cost_so_far = {start: 0.0}
+    parents = {start: None}
+    closed = set()
+    pushed = 1
+    stale = 0
+    peak_frontier = 1
+    while frontier and remaining:
+        g_value, _, actual_node = heappop(frontier)
+        if actual_node in closed:
+            stale += 1
+            continue
+        closed.add(actual_node)
+        remaining.discard(actual_node)
+        x, y = actual_node
+        for neighbor in grid.neighbors(x, y):
+            if neighbor in closed:
+                continue
+            new_g = g_value + grid.cost(x, y, neighbor[0], neighbor[1])
+            if new_g < cost_so_far.get(neighbor, inf):
+                cost_so_far[neighbor] = new_g
+                parents[neighbor] = actual_node
+                heappush(frontier, (new_g, next(tiebreak), neighbor))
+                pushed += 1
+        if len(frontier) > peak_frontier:
+            peak_frontier = len(frontier)
+    if stats is not None:
+        stats["expanded"] = len(closed)
+        stats["pushed"] = pushed
+        stats["stale"] = stale
+        stats["peak_frontier"] = peak_frontier
+        if "cells" in stats:
+            stats["cells"].extend(closed)
+    results = {}
+    for target in targets:
+        if target in closed:
+            results[target] = (build_path(parents, target), cost_so_far[target])
+        else:
+            results[target] = ([], inf)
+    return results
+
+
+def bidirectional_a_star(grid, start, final, stats=None):
+    """
+    Bidirectional A* with the average potential p(v) = (h(v, final) - h(start, v)) / 2, which
+    keeps both searches consistent. The forward key is g(v) + p(v) and the reverse key is
+    g_reverse(v) - p(v), the search stops once the two smallest keys add up to the best
+    meeting cost found so far
+    :param grid: weighted grid
+    :param start: starting node
+    :param final: ending node
+    :param stats: optional dictionary that receives search counters, per direction as well
+    :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+    """
+    heuristic = grid.heuristic
+    xs, ys = start
+    xf, yf = final
+
+    def potential(x, y):
+        return (heuristic(x, y, xf, yf) - heuristic(xs, ys, x, y)) / 2
+
+    def predecessors(x, y):
+        # nodes that can step onto (x, y), the start is allowed even when out of bounds
+        for node in ((x, y + 1), (x + 1, y), (x - 1, y), (x, y - 1)):
+            if node == start or grid.in_bounds(node):
+                yield node
+
+    tiebreak = count()
+    frontiers = ([(potential(xs, ys), next(tiebreak), start)], [(-potential(xf, yf), next(tiebreak), final)])
+    cost_so_far = ({start: 0.0}, {final: 0.0})
+    parents = ({start: None}, {final: None})
+    closed = (set(), set())
+    pushed = 2
+    stale = 0
+    peak_frontier = 2
+    best = inf if start != final else 0.0
+    meeting = None if start != final else start
+    if start != final and not grid.in_bounds(final):
+        frontiers = ([], [])
+    while frontiers[0] and frontiers[1]:
+        if frontiers[0][0][0] + frontiers[1][0][0] >= best:
+            break
+        # expand the direction with the smaller frontier
+        side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+        key, _, actual_node = heappop(frontiers[side])
+        if actual_node in closed[side]:
+            stale += 1
+            continue
+        closed[side].add(actual_node)
+        x, y = actual_node
+        g_value = cost_so_far[side][actual_node]
+        other = cost_so_far[1 - side]
+        sign = 1 if side == 0 else -1
+        nodes = grid.neighbors(x, y) if side == 0 else predecessors(x, y)
+        for neighbor in nodes:
+            if neighbor in closed[side]:
+                continue
+            if side == 0:
+                new_g = g_value + grid.cost(x, y, neighbor[0], neighbor[1])
+            else:
+                new_g = g_value + grid.cost(neighbor[0], neighbor[1], x, y)
+            if new_g < cost_so_far[side].get(neighbor, inf):
+                cost_so_far[side][neighbor] = new_g
+                parents[side][neighbor] = actual_node
+                heappush(frontiers[side], (new_g + sign * potential(neighbor[0], neighbor[1]),
+                                           next(tiebreak), neighbor))
+                pushed += 1
+                if neighbor in other and new_g + other[neighbor] < best:
+                    best = new_g + other[neighbor]
+                    meeting = neighbor
+        if len(frontiers[0]) + len(frontiers[1]) > peak_frontier:
+            peak_frontier = len(frontiers[0]) + len(frontiers[1])
+    if stats is not None:
+        stats["expanded_forward"] = len(closed[0])
+        stats["expanded_reverse"] = len(closed[1])
+        stats["expanded"] = len(closed[0]) + len(closed[1])
+        stats["pushed"] = pushed
+        stats["stale"] = stale
+        stats["peak_frontier"] = peak_frontier
+        if "cells" in stats:
+            stats["cells"].extend(closed[0] | closed[1])
+    if meeting is None:
+        return [], inf
+    path = build_path(parents[0], meeting)
+    curr = parents[1][meeting]
+    while curr is not None:
+        path.append(curr)
+        curr = parents[1][curr]
+    return path, best
+
+
+def anytime_a_star(grid, start, final, stats=None, budget=None, epsilon=1.0, inflation=ANYTIME_INFLATION,
+                   on_path=None):
+    """
+    Anytime repairing A* (ARA*). A weighted A* with the heuristic inflated by inflation finds a
+    first path quickly, the weight is then lowered step by step and each pass only re-expands the
+    nodes whose travel time improved, until the weight reaches epsilon or the budget runs out.
+    The returned path costs at most stats["bound"] times the optimal travel time
+    :param grid: weighted grid
+    :param start: starting node
+    :param final: ending node
+    :param stats: optional dictionary that receives search counters and the achieved bound
+    :param budget: optional wall time budget in seconds, checked once a first path is known
+    :param epsilon: suboptimality bound that is good enough, 1 searches down to the optimal path
+    :param inflation: weight of the heuristic in the first pass
+    :param on_path: optional callback (path, travel time, bound) receiving every improved path
+    :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+    """
+    deadline = perf_counter() + budget if budget is not None else None
+    xf, yf = final
+    weight = max(inflation, epsilon, 1.0)
+    cost_so_far = {start: 0.0}
+    parents = {start: None}
+    # open maps a queued node to its f value, heap entries that no longer match it are stale
+    open_nodes = {start: weight * grid.heuristic(start[0], start[1], xf, yf)}
+    frontier = [(open_nodes[start], 0, start)]
+    tiebreak = count(1)
+    closed = set()
+    inconsistent = set()
+    expanded = 0
+    pushed = 1
+    stale = 0
+    peak_frontier = 1
+    passes = 0
+    # nodes expanded in any pass, only kept when the caller asks for them
+    cells = set() if stats is not None and "cells" in stats else None
+    best = ([], inf)
+    bound = inf
+    while True:
+        passes += 1
+        interrupted = False
+        while frontier:
+            f, _, actual_node = frontier[0]
+            if open_nodes.get(actual_node) != f:
+                heappop(frontier)
+                stale += 1
+                continue
+            if cost_so_far.get(final, inf) <= f:
+                break
+            if deadline is not None and best[0] and expanded % ANYTIME_CHECK == 0 and perf_counter() > deadline:
+                interrupted = True
+                break
+            heappop(frontier)
+            del open_nodes[actual_node]
+            closed.add(actual_node)
+            expanded += 1
+            if cells is not None:
+                cells.add(actual_node)
+            x, y = actual_node
+            g_value = cost_so_far[actual_node]
+            for neighbor in grid.neighbors(x, y):
+                new_g = g_value + grid.cost(x, y, neighbor[0], neighbor[1])
+                if new_g < cost_so_far.get(neighbor, inf):
+                    cost_so_far[neighbor] = new_g
+                    parents[neighbor] = actual_node
+                    if neighbor in closed:
+                        # expanded already in this pass, it waits for the next one
+                        inconsistent.add(neighbor)
+                    else:
+                        f_value = new_g + weight * grid.heuristic(neighbor[0], neighbor[1], xf, yf)
+                        open_nodes[neighbor] = f_value
+                        heappush(frontier, (f_value, next(tiebreak), neighbor))
+                        pushed += 1
+            if len(frontier) > peak_frontier:
+                peak_frontier = len(frontier)
+        if final not in cost_so_far:
+            break
+        if not interrupted:
+            # the optimal travel time is at least the smallest unweighted f value left to expand
+            lower = min((cost_so_far[node] + grid.heuristic(node[0], node[1], xf, yf)
+                         for node in list(open_nodes) + list(inconsistent)), default=inf)
+            bound = min(weight, cost_so_far[final] / lower if lower > 0 else weight, bound)
+        if cost_so_far[final] < best[1]:
+            # an interrupted pass can still have improved the path, the last bound covers it
+            path = build_path(parents, final)
+            time = path_time(grid, path)
+            best = (path, time)
+            if on_path is not None:
+                on_path(path, time, max(bound, 1.0))
+        if interrupted or bound <= epsilon or weight <= 1.0 or (deadline is not None and perf_counter() > deadline):
+            break
+        weight = max(weight - ANYTIME_STEP, epsilon, 1.0)
+        for node in inconsistent:
+            open_nodes[node] = 0.0
+        inconsistent = set()
+        closed = set()
+        for node in open_nodes:
+            open_nodes[node] = cost_so_far[node] + weight * grid.heuristic(node[0], node[1], xf, yf)
+        frontier = [(f_value, next(tiebreak), node) for node, f_value in open_nodes.items()]
+        heapify(frontier)
+    if stats is not None:
+        stats["expanded"] = expanded
+        stats["pushed"] = pushed
+        stats["stale"] = stale
+        stats["passes"] = passes
+        stats["bound"] = max(bound, 1.0) if best[0] else inf
+        stats["peak_frontier"] = peak_frontier
+        if cells is not None:
+            stats["cells"].extend(cells)
+    return best
+
+
+def travel_times(grid, source, reverse=False, steps=False):
+    """
+    Dijkstra over the whole grid on flat arrays indexed by y * width + x
+    :param grid: weighted grid
+    :param source: (x, y) of the source
+    :param reverse: travel times towards source instead of from it
+    :param steps: also return, for every pixel, the index in STEPS of the step
+                  that leads one pixel closer to the source along the tree
+    :return: float32 array of travel times, inf where unreachable, and the uint8 step array
+             (NO_STEP for the source and unreachable pixels) when steps is set
+    """
+    width = grid.width
+    size = grid.width * grid.height
+    speed = np.asarray(grid.speed, dtype=np.float64).ravel().tolist()
+    elevation = np.asarray(grid.elevation, dtype=np.float64).ravel().tolist()
+    passable = (np.asarray(grid.terrain) != OUT_OF_BOUNDS).ravel().tolist()
+    lengths = [PIXEL_HEIGHT if dy else PIXEL_WIDTH for dx, dy in STEPS]
+    times = [inf] * size
+    towards = [NO_STEP] * size
+    closed = [False] * size
+    begin = source[1] * width + source[0]
+    times[begin] = 0.0
+    frontier = [(0.0, begin)]
+    while frontier:
+        g_value, i = heappop(frontier)
+        if closed[i]:
+            continue
+        closed[i] = True
+        if reverse and not passable[i]:
+            # nothing can step onto an out of bounds pixel
+            continue
+        x = i % width
+        for k in range(4):
+            dx, dy = STEPS[k]
+            if not 0 <= x + dx < width:
+                continue
+            j = i + dx + dy * width
+            # an out of bounds start can still step off, so reverse times reach out of bounds
+            # pixels, which are never expanded
+            if j < 0 or j >= size or closed[j] or not (passable[j] or reverse):
+                continue
+            dz = elevation[j] - elevation[i]
+            step = lengths[k]
+            new_g = g_value + sqrt(step * step + dz * dz) / (speed[j] if reverse else speed[i])
+            if new_g < times[j]:
+                times[j] = new_g
+                towards[j] = OPPOSITE[k]
+                heappush(frontier, (new_g, j))
+    times = np.array(times, dtype=np.float32)
+    if steps:
+        return times, np.array(towards, dtype=np.uint8)
+    return times
+
+
+def hpa_star(grid, start, final, stats=None):
+    """
+    Hierarchical A* over the cluster graph of the grid, built on first use, see ClusterGraph.
+    Approximate: the refinement only searches a corridor around the abstract path, so the
+    route can be slower than the optimal one, stats["approximate"] is set to tell callers
+    :param grid: weighted grid
+    :param start: starting node
+    :param final: ending node
+    :param stats: optional dictionary that receives search counters
+    :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+    """
+    from ClusterGraph import ClusterGraph
+    if grid.cluster_graph is None or grid.cluster_graph.fingerprint != grid.fingerprint():
+        grid.cluster_graph = ClusterGraph(grid)
+    return grid.cluster_graph.search(grid, start, final, stats)
+
+
+def alt_star(grid, start, final, stats=None):
+    """
+    A* guided by the landmark lower bounds of the grid, built on first use, see Landmarks
+    :param grid: weighted grid
+    :param start: starting node
+    :param final: ending node
+    :param stats: optional dictionary that receives search counters
+    :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+    """
+    from Landmarks import Landmarks
+    from SearchWorkspace import borrowed
+    if grid.landmarks is None or grid.landmarks.fingerprint != grid.fingerprint():
+        grid.landmarks = Landmarks(grid)
+    bound = grid.landmarks.lower_bound(grid, final)
+    with borrowed() as workspace:
+        # the float32 tables round the bounds, which can make them slightly inconsistent
+        return workspace.a_star(grid, start, final, stats, bound=bound, reopen=True)
+
+
+def flow_star(grid, start, final, stats=None):
+    """
+    Walks the flow field of final, one reverse Dijkstra per goal serves every start, see FlowField
+    :param grid: weighted grid
+    :param start: starting node
+    :param final: ending node
+    :param stats: optional dictionary that receives search counters
+    :return: (list of nodes from start to final, travel time), ([], inf) if unreachable
+    """
+    from FlowField import FlowFieldCache
+    if grid.flow_fields is None:
+        grid.flow_fields = FlowFieldCache()
+    field = grid.flow_fields.get(grid, final, stats)
+    path = field.path(start)
+    if not path:
+        return [], inf
+    return path, path_time(grid, path)
+
+
+# Engines whose routes are not guaranteed to be optimal
+APPROXIMATE_ENGINES = ("hpa",)
+
+
+def is_exact(method, stats):
+    """
+    Tells whether a solved leg is guaranteed to be optimal, e.g. before it is memoized
+    :param method: name of the engine in ENGINES
+    :param stats: search counters of the leg
+    :return: True for optimal legs
+    """
+    return method not in APPROXIMATE_ENGINES and not stats.get("approximate") and stats.get("bound", 1.0) <= 1.0
+
+
+# Engines selectable by name, see APPROXIMATE_ENGINES for the ones that trade optimality for speed
+ENGINES = {
+    "astar": flat_a_star,
+    "bidirectional": bidirectional_a_star,
+    "hpa": hpa_star,
+    "alt": alt_star,
+    "flow": flow_star,
+    "anytime": anytime_a_star,
+}
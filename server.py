@@ -0,0 +1,223 @@
+import argparse
+import base64
+import io
+import json
+import math
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from LegCache import LegCache
+from MapCache import MapCache
+from main import finite_json, project1, prepare_season
+from render import base_image, draw_legs, thumbnail
+from Season import SEASONS
+from search import ENGINES
+
+"""
+Long lived routing service. The map and elevation are loaded once, the four seasonal
+grids are kept in memory and every request only runs the searches.
+
+POST /route  {"season": "winter", "points": [[230, 327], [276, 279]], "render": false, "method": "astar",
+              "color_legs": false, "thumbnail": null}
+returns      {"season": ..., "legs": [{"start", "end", "path", "time", "distance", "stats"}],
+              "time": ..., "distance": ..., "image": base64 png when render is true}
+             with "method": "anytime" the request may add "budget", seconds shared by the legs, and
+             "epsilon", the accepted suboptimality, the achieved bound is in the stats of each leg
+             "method": "hpa" is approximate, its legs have "approximate": true in their stats
+
+POST /converge  {"season": "winter", "goal": [276, 279], "starts": [[230, 327], [68, 291]]}
+returns         {"season": ..., "goal": ..., "routes": [{"start", "path", "time", "distance", "stats"}]}
+                every start is routed on the flow field of the goal, unreachable starts get no path
+"""
+
+class RouteError(Exception):
+    pass
+
+
+def is_coordinate(value):
+    """
+    Tells whether a decoded JSON value is a whole number, int() would also take true, 1.5 and "1"
+    :param value: decoded JSON value
+    :return: boolean
+    """
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or isinstance(value, float) and value.is_integer()
+
+
+class RouteService:
+    def __init__(self, image_file, elevation_file, cache_dir=None, leg_store=None, hierarchy=False,
+                 landmarks=False):
+        """
+        Loads the map once and prepares every season
+        :param image_file: terrain image file
+        :param elevation_file: elevation file
+        :param cache_dir: optional directory of the preprocessed map cache
+        :param leg_store: optional sqlite file persisting solved legs
+        :param hierarchy: build the cluster graphs of the hpa engine up front
+        :param landmarks: build the landmark tables of the alt engine up front
+        """
+        drive = project1(image_file, elevation_file, None, None, None)
+        cache = MapCache(cache_dir) if cache_dir else None
+        self.leg_cache = LegCache(store_file=leg_store)
+        self.seasons = {season: prepare_season(drive, season, cache, hierarchy, landmarks) for season in SEASONS}
+        for drive_season in self.seasons.values():
+            drive_season.leg_cache = self.leg_cache
+        # map images without routes, built on the first rendered request of a season
+        self.base_images = {}
+
+    def season_of(self, request):
+        """
+        Prepared season of a request
+        :param request: decoded JSON request
+        :return: (season name, Season)
+        """
+        season = request.get("season", "summer")
+        if not isinstance(season, str) or season not in self.seasons:
+            raise RouteError("unknown season: " + str(season))
+        return season, self.seasons[season]
+
+    def read_points(self, grid, points, name):
+        """
+        Validates a list of [x, y] pairs of a request
+        :param grid: weighted grid of the season
+        :param points: decoded JSON value
+        :param name: name of the request field, used in errors
+        :return: list of (x, y)
+        """
+        if not isinstance(points, list) or not all(
+                isinstance(point, list) and len(point) == 2 and all(map(is_coordinate, point)) for point in points):
+            raise RouteError(name + " must be a list of [x, y] pairs")
+        points = [(int(point[0]), int(point[1])) for point in points]
+        for x, y in points:
+            if not (0 <= x < grid.width and 0 <= y < grid.height):
+                raise RouteError("point outside the map: " + str((x, y)))
+        return points
+
+    def route(self, request):
+        """
+        Routes the control points of a request in order
+        :param request: decoded JSON request
+        :return: JSON serializable response
+        """
+        season, drive_season = self.season_of(request)
+        grid = drive_season.grid
+        method = request.get("method", "astar")
+        if not isinstance(method, str) or method not in ENGINES:
+            raise RouteError("unknown method: " + str(method))
+        points = self.read_points(grid, request.get("points"), "points")
+        if len(points) < 2:
+            raise RouteError("at least two points are needed")
+        options = {}
+        for name in ("budget", "epsilon"):
+            if request.get(name) is not None:
+                if method != "anytime":
+                    raise RouteError(name + " needs the anytime method")
+                try:
+                    options[name] = float(request[name])
+                except (TypeError, ValueError):
+                    raise RouteError(name + " must be a number")
+                # json.loads accepts NaN and Infinity
+                if not math.isfinite(options[name]):
+                    raise RouteError(name + " must be a finite number")
+        if options.get("budget", 0) < 0 or options.get("epsilon", 1) < 1:
+            raise RouteError("budget must be positive and epsilon at least 1")
+        if "budget" in options:
+            # the budget of the request is shared by its legs
+            options["budget"] /= len(points) - 1
+        legs = []
+        for start, final in zip(points, points[1:]):
+            stats = {}
+            path, time = drive_season.solve(start, final, stats, method, options)
+            if not path:
+                raise RouteError("no path from " + str(start) + " to " + str(final))
+            legs.append({"start": start, "end": final, "path": path, "time": time,
+                         "distance": drive_season.path_distance(path), "stats": stats})
+        response = {"season": season, "legs": legs,
+                    "time": sum(leg["time"] for leg in legs),
+                    "distance": sum(leg["distance"] for leg in legs)}
+        if request.get("render"):
+            if season not in self.base_images:
+                self.base_images[season] = base_image(grid.terrain)
+            image = draw_legs(self.base_images[season].copy(), [leg["path"] for leg in legs], (255, 0, 0),
+                              bool(request.get("color_legs")))
+            if request.get("thumbnail") is not None:
+                try:
+                    size = int(request["thumbnail"])
+                except (TypeError, ValueError):
+                    size = 0
+                if size <= 0:
+                    raise RouteError("thumbnail must be a size in pixels")
+                image = thumbnail(image, size)
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+            response["image"] = base64.b64encode(buffer.getvalue()).decode("ascii")
+        return response
+
+    def converge(self, request):
+        """
+        Routes many starts to one goal from a single flow field
+        :param request: decoded JSON request
+        :return: JSON serializable response
+        """
+        season, drive_season = self.season_of(request)
+        grid = drive_season.grid
+        goal = self.read_points(grid, [request.get("goal")], "goal")[0]
+        starts = self.read_points(grid, request.get("starts"), "starts")
+        routes = []
+        for start in starts:
+            stats = {}
+            path, time = drive_season.solve(start, goal, stats, "flow")
+            routes.append({"start": start, "path": path, "time": time if path else None,
+                           "distance": drive_season.path_distance(path) if path else None, "stats": stats})
+        return {"season": season, "goal": goal, "routes": routes}
+
+
+class RouteHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        endpoints = {"/route": self.server.service.route, "/converge": self.server.service.converge}
+        if self.path not in endpoints:
+            self.send_json(404, {"error": "unknown endpoint"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise RouteError("request must be a JSON object")
+            self.send_json(200, endpoints[self.path](request))
+        except (ValueError, RouteError) as error:
+            self.send_json(400, {"error": str(error)})
+
+    def send_json(self, status, body):
+        """
+        Sends a JSON response
+        :param status: HTTP status
+        :param body: JSON serializable body
+        :return: None
+        """
+        data = json.dumps(finite_json(body), allow_nan=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Orienteering routing service")
+    parser.add_argument("image_file", help="terrain image")
+    parser.add_argument("elevation_file", help="elevation file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--cache-dir", help="directory of the preprocessed map cache")
+    parser.add_argument("--leg-store", help="sqlite file persisting solved legs between runs")
+    parser.add_argument("--hierarchy", action="store_true", help="build the cluster graphs of the approximate hpa engine at startup")
+    parser.add_argument("--landmarks", action="store_true", help="build the landmark tables of the alt engine at startup")
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), RouteHandler)
+    server.service = RouteService(args.image_file, args.elevation_file, args.cache_dir, args.leg_store,
+                                  args.hierarchy, args.landmarks)
+    print("serving on http://" + args.host + ":" + str(args.port) + "/route and /converge")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
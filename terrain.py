@@ -0,0 +1,78 @@
+import numpy as np
+
+"""
+Terrain classes shared by the grid, the season transform and the renderer.
+Every pixel of the map is stored as a uint8 index into TERRAIN_COLORS.
+"""
+
+OUT_OF_BOUNDS = 0
+FOOTPATH = 1
+PAVED_ROAD = 2
+LAKE = 3
+VEGETATION = 4
+FOREST_WALK = 5
+SLOW_RUN_FOREST = 6
+EASY_FOREST = 7
+ROUGH_MEADOW = 8
+OPEN_LAND = 9
+MUD = 10
+ICE = 11
+LEAVES = 12
+
+# Index i holds the map colour of terrain class i
+TERRAIN_COLORS = [
+    (205, 0, 101),
+    (0, 0, 0),
+    (71, 51, 3),
+    (0, 0, 255),
+    (5, 73, 24),
+    (2, 136, 40),
+    (2, 208, 60),
+    (255, 255, 255),
+    (255, 192, 0),
+    (248, 148, 18),
+    (86, 54, 0),
+    (178, 255, 255),
+    (0, 255, 255),
+]
+
+TERRAIN_PALETTE = np.array(TERRAIN_COLORS, dtype=np.uint8)
+
+# Real world size of a pixel in meters, along x and along y
+PIXEL_WIDTH = 10.29
+PIXEL_HEIGHT = 7.55
+
+
+def color_class(color):
+    """
+    Terrain class of a single map colour
+    :param color: (r, g, b) tuple
+    :return: terrain class index
+    """
+    return TERRAIN_COLORS.index(tuple(color))
+
+
+def classify(rgb):
+    """
+    Converts an RGB image array to terrain classes, unknown colours are treated as out of bounds
+    :param rgb: array of shape (height, width, 3)
+    :return: uint8 array of shape (height, width)
+    """
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    packed = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+    keys = np.array([(r << 16) | (g << 8) | b for r, g, b in TERRAIN_COLORS], dtype=np.uint32)
+    order = np.argsort(keys)
+    position = np.searchsorted(keys[order], packed)
+    position[position == len(keys)] = 0
+    classes = order[position].astype(np.uint8)
+    classes[keys[classes] != packed] = OUT_OF_BOUNDS
+    return classes
+
+
+def to_rgb(classes):
+    """
+    Converts terrain classes back to an RGB image array
+    :param classes: uint8 array of shape (height, width)
+    :return: uint8 array of shape (height, width, 3)
+    """
+    return TERRAIN_PALETTE[classes]